@@ -26,6 +26,16 @@ config = {
     },
     'log_level': 'INFO',
     'db_url': 'postgres:///dozer',
+    'db_replica_url': None,
+    'db_slow_query_threshold': 0.5,
+    'db_pool': {
+        'min_size': 10,
+        'max_size': 10,
+        'max_inactive_connection_lifetime': 300.0,
+        'statement_cache_size': 100,
+        'acquire_timeout': 10.0,
+        'acquire_warn_threshold': 0.5
+    },
     'gmaps_key': "PUT GOOGLE MAPS API KEY HERE",
     'tz_url': '',
     'discord_token': "Put Discord API Token here.",
@@ -67,8 +77,9 @@ for ext in os.listdir('dozer/cogs'):
     if not ext.startswith(('_', '.')):
         bot.load_extension('dozer.cogs.' + ext[:-3])  # Remove '.py'
 
+orm.slow_query_threshold = config['db_slow_query_threshold']
 loop = asyncio.get_event_loop()
-loop.run_until_complete(orm.connect(dsn=config['db_url']))
+loop.run_until_complete(orm.connect(dsn=config['db_url'], replica_dsn=config['db_replica_url'], **config['db_pool']))
 loop.run_until_complete(orm.Model.create_all_tables())
 bot.run()
 
@@ -1,9 +1,35 @@
-"""Module that contains the class that will reduce calls to postgres as much as possible. Has no growth limit (yet)"""
+"""Module that contains the class that will reduce calls to postgres as much as possible. Bounded in size, with optional expiry."""
+import asyncio
+import collections
+import time
+
+
 class AsyncConfigCache:
-    """Class that will reduce calls to postgres as much as possible. Has no growth limit (yet)"""
-    def __init__(self, table):
-        self.cache = {}
+    """Class that will reduce calls to postgres as much as possible.
+
+    max_size: the most entries kept before the least recently used ones are evicted
+    ttl: seconds a found entry stays valid for, or None to keep it until it is invalidated or evicted
+    negative_ttl: seconds an empty result (None or []) stays valid for, or None to keep it like any other entry
+    """
+    def __init__(self, table, max_size=4096, ttl=None, negative_ttl=300):
+        # query hash -> (expiry timestamp or None, result), least recently used first
+        self.cache = collections.OrderedDict()
         self.table = table
+        # query hash -> task loading that entry, so concurrent misses for the same key share one query
+        self._inflight = {}
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        # bumped on every invalidation, so a preload can tell whether what it read may already be stale
+        self._generation = 0
+        # drop entries when this or any other process writes to the table
+        table._orm.add_invalidation_listener(self._on_invalidation)
 
     @staticmethod
     def _hash_dict(dic):
@@ -14,22 +40,126 @@ class AsyncConfigCache:
             values.append((k, dic[k]))
         return tuple(values)
 
+    def _get(self, query_hash):
+        """Returns (True, result) if there's a live cache entry for the hash, and (False, None) otherwise."""
+        entry = self.cache.get(query_hash)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires, result = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.cache[query_hash]
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+        self.cache.move_to_end(query_hash)
+        self.hits += 1
+        return True, result
+
+    def _put(self, query_hash, result):
+        """Stores a result in the cache, evicting the least recently used entries if the cache is full."""
+        ttl = self.negative_ttl if result is None or result == [] else self.ttl
+        self.cache[query_hash] = (None if ttl is None else time.monotonic() + ttl, result)
+        self.cache.move_to_end(query_hash)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    async def _load(self, query_hash, loader, kwargs):
+        """Looks up a query hash, running loader(**kwargs) on a miss.
+        Concurrent misses for the same hash wait on the first one's query instead of issuing their own."""
+        found, result = self._get(query_hash)
+        if found:
+            return result
+        task = self._inflight.get(query_hash)
+        if task is None:
+            task = asyncio.ensure_future(self._fill(query_hash, loader, kwargs))
+            self._inflight[query_hash] = task
+        else:
+            self.coalesced += 1
+        # shielded so that one waiter being cancelled doesn't cancel the query for everyone else
+        return await asyncio.shield(task)
+
+    async def _fill(self, query_hash, loader, kwargs):
+        """Runs a query and caches its result, unless the entry was invalidated while the query was running."""
+        try:
+            result = await loader(**kwargs)
+            if self._inflight.get(query_hash) is asyncio.current_task():
+                self._put(query_hash, result)
+            return result
+        finally:
+            if self._inflight.get(query_hash) is asyncio.current_task():
+                del self._inflight[query_hash]
+
+    async def load_one(self, **kwargs):
+        """Fetches a single entry from the database. Subclasses can override this to change what a miss does."""
+        return await self.table.select_one(**kwargs)
+
+    async def load_all(self, **kwargs):
+        """Fetches all matching entries from the database."""
+        # from the primary, since an entry cached from a lagging replica would outlive the invalidation for the write it missed
+        return await self.table.select(_primary=True, **kwargs)
+
+    async def load_many(self, field, values):
+        """Fetches the entries for many values of one field in a single query."""
+        return await self.table.fetch(f"SELECT * FROM {self.table.table_name()} WHERE {field} = ANY($1)", list(values),
+                                      _primary=True)
+
+    async def preload(self, field, values):
+        """Warms the cache so that query_one(field=value) hits for each of the values, using one query for all of them.
+        Values that are already cached are skipped, and values without a row are cached as None."""
+        values = [v for v in values if self._hash_dict({field: v}) not in self.cache]
+        if not values:
+            return
+        generation = self._generation
+        found = {getattr(row, field): row for row in await self.load_many(field, values)}
+        if generation != self._generation:
+            # something was written while we were reading; let those entries load on demand instead
+            return
+        for value in values:
+            self._put(self._hash_dict({field: value}), found.get(value))
+
     async def query_one(self, **kwargs):
         """Query the cache for an entry matching the kwargs, then try again using the database."""
-        query_hash = self._hash_dict(kwargs)
-        if query_hash not in self.cache:
-            self.cache[query_hash] = await self.table.select_one(**kwargs)
-        return self.cache[query_hash]
+        return await self._load(self._hash_dict(kwargs), self.load_one, kwargs)
 
     async def query_all(self, **kwargs):
         """Query the cache for all entries matching the kwargs, then try again using the database."""
-        query_hash = self._hash_dict(kwargs)
-        if query_hash not in self.cache:
-            self.cache[query_hash] = await self.table.select(**kwargs)
-        return self.cache[query_hash]
+        # tagged so query_all and query_one with the same kwargs don't share an entry
+        return await self._load(("all",) + self._hash_dict(kwargs), self.load_all, kwargs)
 
     def invalidate_entry(self, **kwargs):
         """Removes an entry from the cache if it exists - used to mark changed data."""
         query_hash = self._hash_dict(kwargs)
-        if query_hash in self.cache:
-            del self.cache[query_hash]
+        self._generation += 1
+        for key in (query_hash, ("all",) + query_hash):
+            self.cache.pop(key, None)
+            # an in-flight query may have read the old data, so it shouldn't be cached either
+            self._inflight.pop(key, None)
+
+    def _on_invalidation(self, table_name, keys):
+        """Evicts every entry that could match rows written with the given keys.
+        An entry matches unless one of its query fields was written with a different value."""
+        if table_name not in (None, self.table.table_name()):
+            return
+        self._generation += 1
+        for cache in (self.cache, self._inflight):
+            for query_hash in list(cache):
+                fields = query_hash[1:] if query_hash[:1] == ("all",) else query_hash
+                if all(keys.get(k, v) == v for k, v in fields):
+                    del cache[query_hash]
+                    self.invalidations += 1
+
+    def stats(self):
+        """Returns the cache's size and hit/miss/eviction counters."""
+        return {
+            "size": len(self.cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            "in_flight": len(self._inflight),
+        }
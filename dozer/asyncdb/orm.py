@@ -14,10 +14,154 @@ One can use the defualt orm instance or instantiate your own for other dbs.
 """
 import json
 import asyncio
+import contextlib
+import logging
+import re
+import time
+import weakref
+from collections import deque
 import asyncpg
 
 from .psqlt import Column
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("dozer")
+
+# literals (but not $n placeholders) are stripped when grouping query stats, so hand-written SQL doesn't get an entry per value
+_sql_literal_re = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?")
+_sql_param_re = re.compile(r"\$(\d+)")
+# asyncpg.create_pool arguments that asyncpg.connect doesn't take, left out when opening the LISTEN connection
+_pool_only_kwargs = frozenset(("min_size", "max_size", "max_queries", "max_inactive_connection_lifetime", "setup", "init", "reset"))
+
+class QueryStats:
+    """Running totals for one normalised SQL statement issued by one model."""
+    __slots__ = ("count", "errors", "total", "min", "max", "rows", "pool_wait", "samples", "example")
+    # how many recent latencies are kept for percentiles
+    SAMPLES = 512
+
+    def __init__(self, example=None):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.rows = 0
+        self.pool_wait = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+        # one un-normalised instance of the statement, so it can be EXPLAINed
+        self.example = example
+
+    def add(self, elapsed, rows, pool_wait, failed=False):
+        """Records one execution."""
+        self.count += 1
+        self.errors += failed
+        self.total += elapsed
+        self.min = min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.rows += rows
+        self.pool_wait += pool_wait
+        self.samples.append(elapsed)
+
+    def percentile(self, pct):
+        """Returns the pct-th percentile of the recent latencies."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def snapshot(self):
+        """Returns the stats as a dict, with times in seconds."""
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "rows": self.rows,
+            "pool_wait": self.pool_wait,
+            "example": self.example,
+        }
+
+
+class PoolStats:
+    """Counters and a latency histogram for connection acquires from an asyncpg pool."""
+    # upper bounds (in seconds) of the acquire latency histogram buckets
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+    def __init__(self):
+        self.acquires = 0
+        self.waiters = 0
+        self.timeouts = 0
+        self.slow_acquires = 0
+        self.histogram = [0] * len(self.BUCKETS)
+
+    def add(self, wait):
+        """Records one successful acquire."""
+        self.acquires += 1
+        for i, bound in enumerate(self.BUCKETS):
+            if wait <= bound:
+                self.histogram[i] += 1
+                break
+
+    def snapshot(self, pool):
+        """Returns the counters along with the pool's current size as a dict."""
+        size = pool.get_size()
+        idle = pool.get_idle_size()
+        return {
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "min_size": pool.get_min_size(),
+            "max_size": pool.get_max_size(),
+            "waiters": self.waiters,
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "slow_acquires": self.slow_acquires,
+            "acquire_latency": {(f"<={bound * 1000:g}ms" if bound != float("inf") else "slower"): count
+                                for bound, count in zip(self.BUCKETS, self.histogram)},
+        }
+
+
+class JSONCodec:
+    """Converts between python objects and the json and jsonb postgres types, using postgres's binary format.
+    dumps must return UTF-8 encoded bytes and loads must accept them."""
+    # jsonb's binary format is its text form prefixed with a version byte
+    JSONB_VERSION = b"\x01"
+
+    def __init__(self, dumps, loads):
+        self.dumps = dumps
+        self.loads = loads
+
+    def _dumps_jsonb(self, obj):
+        return self.JSONB_VERSION + self.dumps(obj)
+
+    def _loads_jsonb(self, data):
+        if data[:1] != self.JSONB_VERSION:
+            raise ValueError(f"unsupported jsonb format version {data[:1]!r}")
+        return self.loads(data[1:])
+
+    async def register(self, conn):
+        """Sets this codec up for the json and jsonb types on an asyncpg connection."""
+        await conn.set_type_codec('json', encoder=self.dumps, decoder=self.loads, schema='pg_catalog', format='binary')
+        await conn.set_type_codec('jsonb', encoder=self._dumps_jsonb, decoder=self._loads_jsonb, schema='pg_catalog',
+                                  format='binary')
+
+
+if orjson is not None:
+    # OPT_NON_STR_KEYS turns non-string dict keys into strings, like the json module does
+    default_json_codec = JSONCodec(lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads)
+else:
+    default_json_codec = JSONCodec(lambda obj: json.dumps(obj).encode(), json.loads)
+
+
 class class_or_instancemethod(classmethod):
     """cursed cursed cursed cursed cursed cursed cursed cursed cursed cursed cursed"""
     def __get__(self, instance, type_):
@@ -30,12 +174,20 @@ class ORM:
     pool: asyncpg.pool.Pool
     def __init__(self):
         self.ready_event = asyncio.Event()
+        # table name -> columns known to exist, so create_all_tables only hits the catalog for new tables
+        self._verified_columns = {}
+        # table name -> names of the declared indexes known to exist
+        self._verified_indexes = {}
+        # generated SQL strings are cached per model, so these track how often that saves us a rebuild
+        self.sql_cache_stats = {"hits": 0, "misses": 0}
         class Model:
             """Tables subclass this."""
             __schemaname__ = "public"
             __tablename__ = None
             __primary_key__ = None
             __addn_sql__ = None
+            # tuples of column names to create secondary indexes on, e.g. (("guild_id", "member_id"), ("role_id",))
+            __indexes__ = ()
 
             # kwargs are just a way to put in fields
             def __init__(self, conn=None, **kwargs):
@@ -53,96 +205,357 @@ class ORM:
 
             @classmethod
             async def create_all_tables(cls):
-                """Creates all the tables in Postgres and populates all subclasses with necessary runtime information."""
-                async with self.pool.acquire() as conn:
-                    for scls in Model.__subclasses__():
-                        columns = {}
-                        for field_name, field_type in scls.__annotations__.items():
-                            if isinstance(field_type, Column):
-                                columns[field_name] = field_type.sql
-                        scls._columns = columns
-                        scls._orm = self
-                        if scls.__primary_key__:
-                            if not isinstance(scls.__primary_key__, tuple):
-                                raise TypeError(f"Primary key fields should be tuples, did you forget a comma in {scls.__name__}?")
-
-                        async with conn.transaction():
-                            db_columns = await conn.fetch("SELECT column_name from information_schema.columns "
-                                                          "WHERE table_schema = $1 AND table_name = $2",
-                                                          scls.__schemaname__, scls.__tablename__)
-
-                            if db_columns:
-                                db_column_names = set(map(lambda r: r["column_name"], db_columns))
-                                column_names = set(columns.keys())
-                                if column_names - db_column_names:
-                                    raise TypeError(f"columns {column_names - db_column_names} are missing from "
-                                                    f"the {scls.__schemaname__}.{scls.__tablename__} table!")
-                            else:
-
-                                query_params = ", ".join(map(" ".join, zip(columns.keys(), columns.values())))
-                                if scls.__addn_sql__:
-                                    query_params += ", " + scls.__addn_sql__
-                                if scls.__primary_key__:
-                                    query_params += f", PRIMARY KEY({', '.join(k for k in scls.__primary_key__)})"
-                                # "but making sql like this is bad, you say." Yes. Yes it is. It is assumed, however, that this code
-                                # is never fed user inputs, in which case you probably just want a real ORM anyway.
-                                query_str = f"CREATE TABLE IF NOT EXISTS {scls.__schemaname__}.{scls.__tablename__}({query_params})"
-                                await conn.fetch(query_str)
+                """Creates all the tables in Postgres and populates all subclasses with necessary runtime information.
+                Tables already verified by this process (e.g. before a cog reload) aren't checked again."""
+                unverified = []
+                for scls in Model.__subclasses__():
+                    columns = {}
+                    for field_name, field_type in scls.__annotations__.items():
+                        if isinstance(field_type, Column):
+                            columns[field_name] = field_type.sql
+                    scls._columns = columns
+                    scls._orm = self
+                    scls._sql_cache = {}
+                    # rows loaded from the database are instances of a slotted subclass, so they don't carry a __dict__ each
+                    namespace = {"__slots__": tuple(columns.keys()) + ("conn",), "__module__": scls.__module__,
+                                 "__qualname__": scls.__qualname__}
+                    scls._row_class = type(scls.__name__, (scls,), namespace)
+                    if scls.__primary_key__:
+                        if not isinstance(scls.__primary_key__, tuple):
+                            raise TypeError(f"Primary key fields should be tuples, did you forget a comma in {scls.__name__}?")
+                    scls._indexes = {}
+                    for index in scls.__indexes__:
+                        if not isinstance(index, tuple):
+                            raise TypeError(f"Indexes should be tuples, did you forget a comma in {scls.__name__}?")
+                        if set(index) - set(columns.keys()):
+                            raise TypeError(f"{scls.__name__} has an index on unknown columns {set(index) - set(columns.keys())}")
+                        scls._indexes[f"{scls.__tablename__}_{'_'.join(index)}_idx"] = index
+                    if not set(columns.keys()) <= self._verified_columns.get(scls.table_name(), set()) or \
+                            not set(scls._indexes.keys()) <= self._verified_indexes.get(scls.table_name(), set()):
+                        unverified.append(scls)
+
+                if unverified:
+                    # one catalog query each for the columns and indexes of every table we haven't seen yet
+                    table_names = [scls.table_name() for scls in unverified]
+                    async with self.acquire() as conn:
+                        db_columns = await conn.fetch("SELECT table_schema, table_name, column_name FROM information_schema.columns "
+                                                      "WHERE table_schema || '.' || table_name = ANY($1::text[])", table_names)
+                        db_indexes = await conn.fetch("SELECT n.nspname || '.' || t.relname AS table_name, i.relname AS index_name, "
+                                                      "x.indisvalid FROM pg_index x "
+                                                      "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+                                                      "JOIN pg_namespace n ON n.oid = t.relnamespace "
+                                                      "WHERE n.nspname || '.' || t.relname = ANY($1::text[])", table_names)
+                    db_index_names = {}
+                    for r in db_indexes:
+                        db_index_names.setdefault(r["table_name"], {})[r["index_name"]] = r["indisvalid"]
+                    db_column_names = {}
+                    for r in db_columns:
+                        db_column_names.setdefault(f"{r['table_schema']}.{r['table_name']}", set()).add(r["column_name"])
+
+                    to_create = []
+                    for scls in unverified:
+                        column_names = set(scls._columns.keys())
+                        if scls.table_name() in db_column_names:
+                            if column_names - db_column_names[scls.table_name()]:
+                                raise TypeError(f"columns {column_names - db_column_names[scls.table_name()]} are missing from "
+                                                f"the {scls.__schemaname__}.{scls.__tablename__} table!")
+                        else:
+                            to_create.append(scls)
+                            db_column_names[scls.table_name()] = column_names
+
+                    await asyncio.gather(*(scls._create_table() for scls in to_create))
+
+                    index_builds = []
+                    for scls in unverified:
+                        existing = db_index_names.get(scls.table_name(), {})
+                        for name, index in scls._indexes.items():
+                            if not existing.get(name):
+                                # new tables are empty, so only existing ones need to be indexed without blocking writes
+                                index_builds.append(scls._create_index(name, index, concurrently=scls not in to_create,
+                                                                       rebuild=name in existing))
+                    await asyncio.gather(*index_builds)
+                    for scls in unverified:
+                        self._verified_columns[scls.table_name()] = db_column_names[scls.table_name()]
+                        self._verified_indexes[scls.table_name()] = set(scls._indexes.keys())
                 self.ready_event.set()
 
+            @classmethod
+            async def _create_table(cls):
+                """Creates the Model's table."""
+                query_params = ", ".join(map(" ".join, zip(cls._columns.keys(), cls._columns.values())))
+                if cls.__addn_sql__:
+                    query_params += ", " + cls.__addn_sql__
+                if cls.__primary_key__:
+                    query_params += f", PRIMARY KEY({', '.join(k for k in cls.__primary_key__)})"
+                # "but making sql like this is bad, you say." Yes. Yes it is. It is assumed, however, that this code
+                # is never fed user inputs, in which case you probably just want a real ORM anyway.
+                query_str = f"CREATE TABLE IF NOT EXISTS {cls.__schemaname__}.{cls.__tablename__}({query_params})"
+                async with cls._orm.acquire() as conn:
+                    await conn.fetch(query_str)
+
+            @classmethod
+            async def _create_index(cls, name, columns, concurrently=True, rebuild=False):
+                """Creates one of the Model's secondary indexes. CONCURRENTLY builds it without blocking writes to the table."""
+                concurrently = " CONCURRENTLY" if concurrently else ""
+                logger.info(f"Creating index {name} on {cls.table_name()}({', '.join(columns)})")
+                async with cls._orm.acquire() as conn:
+                    if rebuild:
+                        # a failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would skip over
+                        await conn.execute(f"DROP INDEX{concurrently} IF EXISTS {cls.__schemaname__}.{name}")
+                    await conn.execute(f"CREATE INDEX{concurrently} IF NOT EXISTS {name} ON {cls.table_name()}({', '.join(columns)})")
+
+            @classmethod
+            def _build_sql(cls, op, fields, extra):
+                """Builds the SQL string for one of the basic operations. Use _sql() instead, which caches the result.
+                Each operation has its own _build_<op>_sql builder."""
+                builder = getattr(cls, f"_build_{op}_sql", None)
+                if builder is None:
+                    raise ValueError(f"unknown sql operation {op!r}")
+                return builder(fields, extra)
+
+            @classmethod
+            def _build_select_sql(cls, fields, extra):
+                if not fields:
+                    return f"SELECT * FROM {cls.table_name()} " + extra
+                return f"SELECT * FROM {cls.table_name()} WHERE " + " AND ".join(f"{f}=${i}" for i, f in enumerate(fields, 1)) + extra
+
+            @classmethod
+            def _build_insert_sql(cls, fields, extra):
+                return f"INSERT INTO {cls.table_name()}({','.join(fields)}) VALUES(" + ",".join(
+                    f"${i}" for i in range(1, len(fields) + 1)) + ")" + extra
+
+            @classmethod
+            def _build_upsert_sql(cls, fields, extra):
+                pk = tuple(cls.__primary_key__ or ())
+                updates = [f for f in fields if f not in pk]
+                conflict = f" ON CONFLICT ({','.join(pk)}) " + (
+                    ("DO UPDATE SET " + ", ".join(f"{f}=EXCLUDED.{f}" for f in updates)) if updates else "DO NOTHING")
+                return cls._build_insert_sql(fields, conflict + extra)
+
+            @classmethod
+            def _build_increment_sql(cls, fields, extra):
+                # for increments, extra is the tuple of fields that get added to the existing row's values
+                pk = tuple(cls.__primary_key__ or ())
+                conflict = f" ON CONFLICT ({','.join(pk)}) DO UPDATE SET " + ", ".join(
+                    f"{f}={cls.__tablename__}.{f}+EXCLUDED.{f}" for f in extra)
+                return cls._build_insert_sql(fields, conflict)
+
+            @classmethod
+            def _build_update_sql(cls, fields, extra):
+                # for updates, extra is the tuple of fields in the WHERE clause
+                return f"UPDATE {cls.table_name()} SET ({','.join(fields)}) = (" + ",".join(
+                    f"${i}" for i in range(1, len(fields) + 1)) + ") " \
+                    "WHERE " + " AND ".join(f"{f} = ${i}" for i, f in enumerate(extra, len(fields) + 1))
+
+            @classmethod
+            def _build_delete_sql(cls, fields, extra):  # pylint: disable=unused-argument
+                return f"DELETE FROM {cls.table_name()} WHERE " + " AND ".join(f"{f}=${i}" for i, f in enumerate(fields, 1))
+
+            @classmethod
+            def _sql(cls, op, fields, extra=""):
+                """Returns the (cached) SQL string for an operation on this table.
+                Keeping the strings identical between calls also lets asyncpg reuse its per-connection prepared statements.
+                """
+                key = (op, fields, extra)
+                try:
+                    qs = cls._sql_cache[key]
+                except KeyError:
+                    cls._orm.sql_cache_stats["misses"] += 1
+                    qs = cls._sql_cache[key] = cls._build_sql(op, fields, extra)
+                else:
+                    cls._orm.sql_cache_stats["hits"] += 1
+                return qs
+
             @classmethod
             def from_record(cls, record: asyncpg.Record):
                 """Converts an asyncpg.Record into a Model object."""
                 if record is None:
                     return None
-                ret = cls()
+                ret = object.__new__(cls._row_class)
+                ret.conn = None
                 for field in cls._columns.keys():
                     setattr(ret, field, record[field])
                 return ret
 
             @classmethod
-            async def _fetch(cls, args, _one=False, conn=None):
+            def _record_setters(cls, keys, offset=0):
+                """Returns (setter, index) pairs that copy the Model's fields out of a record by position.
+                keys are the names of the record's columns from offset onwards."""
+                row_cls = cls._row_class
+                return [(getattr(row_cls, field).__set__, offset + keys.index(field)) for field in cls._columns.keys()]
+
+            @classmethod
+            def from_records(cls, records):
+                """Converts a list of asyncpg.Records from the same query into Model objects.
+                Column positions are looked up once for the whole list rather than by name for every row."""
+                if not records:
+                    return []
+                row_cls = cls._row_class
+                setters = cls._record_setters(list(records[0].keys()))
+                new = object.__new__
+                ret = []
+                for record in records:
+                    row = new(row_cls)
+                    row.conn = None
+                    for set_field, idx in setters:
+                        set_field(row, record[idx])
+                    ret.append(row)
+                return ret
+
+            @classmethod
+            @contextlib.asynccontextmanager
+            async def transaction(cls):
+                """Acquires a connection and opens a transaction on it, for units of work spanning multiple statements.
+                Pass the yielded connection as _conn to the query methods:
+
+                    async with Model.transaction() as conn:
+                        await a.delete(_conn=conn)
+                        await b.insert(_conn=conn)
+                """
+                async with cls._orm.acquire() as conn:
+                    async with conn.transaction():
+                        yield conn
+
+            @classmethod
+            async def _fetch(cls, args, _one=False, conn=None, replica=False, notify=None):
+                # single statements run in autocommit mode, which is just as atomic without the extra BEGIN/COMMIT round trips.
+                # if conn is already in a transaction (see Model.transaction()), the statement simply becomes part of it.
+                # notify is the keys of a write to announce, which is done on the same connection instead of checking out another.
+                f = 'fetchrow' if _one else 'fetch'
+                start = acquired = time.perf_counter()
                 try:
-                    f = 'fetchrow' if _one else 'fetch'
                     if conn is None:
-                        async with cls._orm.pool.acquire() as conn:
-                            async with conn.transaction():
-                                return await getattr(conn, f)(*args)
+                        async with cls._orm.acquire(replica=replica) as conn:
+                            acquired = time.perf_counter()
+                            ret = await getattr(conn, f)(*args)
+                            if notify is not None:
+                                await cls._notify(notify, conn=conn)
                     else:
-                        async with conn.transaction():
-                            return await getattr(conn, f)(*args)
+                        ret = await getattr(conn, f)(*args)
+                        if notify is not None:
+                            await cls._notify(notify, conn=conn)
                 except asyncpg.PostgresError:
-                    print("query", args[0], "failed!")
+                    logger.exception(f"Query from {cls.__name__} failed: {args[0]}")
+                    cls._orm.record_query(cls.__name__, args[0], time.perf_counter() - acquired, 0, acquired - start, failed=True)
                     raise
+                rows = len(ret) if isinstance(ret, list) else int(ret is not None)
+                cls._orm.record_query(cls.__name__, args[0], time.perf_counter() - acquired, rows, acquired - start)
+                return ret
 
             @classmethod
-            async def fetch(cls, *args, _conn=None):
-                """Equivalent to mapping Model.from_record onto the results of asyncpg.fetch."""
-                return [cls.from_record(r) for r in await cls._fetch(args, conn=_conn)]
+            async def fetch(cls, *args, _conn=None, _primary=False):
+                """Equivalent to mapping Model.from_record onto the results of asyncpg.fetch.
+                Runs on the read replica if there is one, unless _primary is set (e.g. for statements that write)."""
+                return cls.from_records(await cls._fetch(args, conn=_conn, replica=not _primary))
 
             @classmethod
             async def fetchrow(cls, *args, _conn=None):
                 """Equivalent to Model.from_record(await asyncpg.fetch(...))"""
                 return cls.from_record(await cls._fetch(args, _one=True, conn=_conn))
 
+            @classmethod
+            async def iter_fetch(cls, *args, _conn=None, batch_size=100):
+                """Like Model.fetch, but streams the results through a server-side cursor batch_size rows at a time.
+                Use with async for. The connection is held (in a transaction) until iteration finishes."""
+                if _conn is None:
+                    async with cls._orm.acquire() as conn:
+                        async for row in cls.iter_fetch(*args, _conn=conn, batch_size=batch_size):
+                            yield row
+                    return
+                try:
+                    async with _conn.transaction():
+                        cursor = await _conn.cursor(*args)
+                        while True:
+                            records = await cursor.fetch(batch_size)
+                            if not records:
+                                break
+                            for row in cls.from_records(records):
+                                yield row
+                except asyncpg.PostgresError:
+                    logger.exception(f"Streaming query from {cls.__name__} failed: {args[0]}")
+                    raise
+
             async def insert(self, _conn=None, _upsert="", _fields=None):
                 """Inserts the model into the database. Use _upsert to specify an ON CONFLICT or other clause."""
-                fields = _fields or self._columns.keys()
-                qs = f"INSERT INTO {self.__schemaname__}.{self.__tablename__}({','.join(fields)}) VALUES(" + ",".join(
-                    f"${i}" for i in range(1, len(fields) + 1)) + ")" + (_upsert if _upsert else "")
+                fields = tuple(_fields or self._columns.keys())
+                qs = self._sql("insert", fields, _upsert or "")
                 args = [qs] + [getattr(self, f) for f in fields]
-                await self.fetch(*args, _conn=_conn)
+                await self._fetch(args, conn=_conn, notify=self._identity())
+
+            @classmethod
+            async def _bulk_write(cls, rows, fields, qs, conn=None):
+                """Writes many Models in a single transaction. Uses executemany on qs, or COPY if qs is None."""
+                records = [tuple(getattr(row, f) for f in fields) for row in rows]
+                if not records:
+                    return
+
+                async def _write(conn):
+                    async with conn.transaction():
+                        if qs is None:
+                            await conn.copy_records_to_table(cls.__tablename__, records=records, columns=fields,
+                                                             schema_name=cls.__schemaname__)
+                        else:
+                            await conn.executemany(qs, records)
+                        # no keys invalidates everything cached for the table, which is cheaper than a notice per row
+                        await cls._notify({}, conn=conn)
+                start = acquired = time.perf_counter()
+                try:
+                    if conn is None:
+                        async with cls._orm.acquire() as conn:
+                            acquired = time.perf_counter()
+                            await _write(conn)
+                    else:
+                        await _write(conn)
+                except asyncpg.PostgresError:
+                    logger.exception(f"Bulk write of {len(records)} rows into {cls.table_name()} failed")
+                    cls._orm.record_query(cls.__name__, qs or f"COPY {cls.table_name()}", time.perf_counter() - acquired, 0,
+                                          acquired - start, failed=True)
+                    raise
+                cls._orm.record_query(cls.__name__, qs or f"COPY {cls.table_name()}", time.perf_counter() - acquired,
+                                      len(records), acquired - start)
+
+            @classmethod
+            async def insert_many(cls, rows, _conn=None, on_conflict="", _fields=None):
+                """Inserts many Models in a single transaction.
+                Without an on_conflict clause (e.g. "ON CONFLICT DO NOTHING") this uses COPY, otherwise executemany.
+                """
+                fields = tuple(_fields or cls._columns.keys())
+                qs = cls._sql("insert", fields, " " + on_conflict) if on_conflict else None
+                await cls._bulk_write(rows, fields, qs, conn=_conn)
+
+            @classmethod
+            async def upsert_many(cls, rows, _conn=None, _fields=None):
+                """Inserts many Models in a single transaction, overwriting the non primary key fields of any existing rows."""
+                if not cls.__primary_key__:
+                    raise TypeError("upsert_many() requires a primary key on the table")
+                fields = tuple(_fields or cls._columns.keys())
+                await cls._bulk_write(rows, fields, cls._sql("upsert", fields), conn=_conn)
+
+            @classmethod
+            async def increment_many(cls, rows, counters, _conn=None, _fields=None):
+                """Inserts many Models in a single transaction. Where a row already exists, the values of the counters
+                fields are added to the stored ones and the other fields are left alone."""
+                if not cls.__primary_key__:
+                    raise TypeError("increment_many() requires a primary key on the table")
+                fields = tuple(_fields or cls._columns.keys())
+                await cls._bulk_write(rows, fields, cls._sql("increment", fields, tuple(counters)), conn=_conn)
 
             @classmethod
-            async def select(cls, _conn=None, _extra_sql="", **properties):
-                """Queries for Models matching the specified properties. Returns a list of matching results."""
+            async def select(cls, _conn=None, _extra_sql="", _primary=False, **properties):
+                """Queries for Models matching the specified properties. Returns a list of matching results.
+                Reads from the replica if there is one; set _primary when the results must include very recent writes."""
                 if not properties:
-                    return await cls.fetch(f"SELECT * FROM {cls.__schemaname__}.{cls.__tablename__}")
+                    return await cls.fetch(cls._sql("select", (), _extra_sql), _conn=_conn, _primary=_primary)
                 else:
-                    fields = properties.keys()
-                    qs = f"SELECT * FROM {cls.__schemaname__}.{cls.__tablename__} WHERE " + " AND ".join(
-                        f"{f}=${i}" for i, f in enumerate(fields, 1)) + _extra_sql
-                    return await cls.fetch(*([qs] + list(properties.values())), _conn=_conn)
+                    qs = cls._sql("select", tuple(properties.keys()), _extra_sql)
+                    return await cls.fetch(*([qs] + list(properties.values())), _conn=_conn, _primary=_primary)
+
+            @classmethod
+            async def iter_select(cls, _conn=None, _extra_sql="", batch_size=100, **properties):
+                """Like Model.select, but returns an async iterator that streams matching Models with bounded memory."""
+                qs = cls._sql("select", tuple(properties.keys()), _extra_sql)
+                async for row in cls.iter_fetch(*([qs] + list(properties.values())), _conn=_conn, batch_size=batch_size):
+                    yield row
 
             @classmethod
             async def get_by(cls, *args, **kwargs):
@@ -154,8 +567,7 @@ class ORM:
                 """Queries for a single Model matching the specified properties. Similar to .one_or_none() in sqlalchemy."""
                 if not properties:
                     raise ValueError("bruh which one do i pick")
-                fields = properties.keys()
-                qs = f"SELECT * FROM {cls.__schemaname__}.{cls.__tablename__} WHERE " + " AND ".join(f"{f}=${i}" for i, f in enumerate(fields, 1))
+                qs = cls._sql("select", tuple(properties.keys()))
                 return await cls.fetchrow(*([qs] + list(properties.values())), _conn=_conn)
             
             async def update_or_add(self, *args, **kwargs):
@@ -168,21 +580,19 @@ class ORM:
                  """
                 pkeys = self.__primary_key__ or tuple()
                 if _keys is None:
-                    fields = [k for k in self._columns.keys() if k not in pkeys]
+                    fields = tuple(k for k in self._columns.keys() if k not in pkeys)
                 else:
-                    fields = [k for k in self._columns.keys() if k in _keys and k not in pkeys]
+                    fields = tuple(k for k in self._columns.keys() if k in _keys and k not in pkeys)
 
                 if not properties:
                     if not pkeys:
                         raise ValueError("properties must be passed to update() if there is no primary key!")
                     else:
                         properties = {k: getattr(self, k) for k in self.__primary_key__}
-                qs = f"UPDATE {self.__schemaname__}.{self.__tablename__} SET ({','.join(fields)}) = (" + ",".join(
-                    f"${i}" for i in range(1, len(fields) + 1)) + ") " \
-                         "WHERE " + " AND ".join(f"{f} = ${i}" for i, f in enumerate(properties.keys(), len(fields) + 1))
-                # print(qs)
+                qs = self._sql("update", fields, tuple(properties.keys()))
 
-                return await self.fetchrow(*([qs] + [getattr(self, f) for f in fields] + list(properties.values())), _conn=_conn)
+                return self.from_record(await self._fetch([qs] + [getattr(self, f) for f in fields] + list(properties.values()),
+                                                          _one=True, conn=_conn, notify=properties))
 
             @class_or_instancemethod
             async def delete(self_or_cls, _conn=None, **properties):
@@ -199,18 +609,16 @@ class ORM:
                         raise ValueError("properties must be passed to delete() if there is no primary key!")
                     else:
                         properties = {k: getattr(self, k) for k in self.__primary_key__}
-                qs = f"DELETE FROM {self.__schemaname__}.{self.__tablename__} WHERE " + " AND ".join(
-                    f"{f}=${i}" for i, f in enumerate(properties.keys(), 1))
-                return await self.fetch(*([qs] + list(properties.values())), _conn=_conn)
+                qs = self._sql("delete", tuple(properties.keys()))
+                return self.from_records(await self._fetch([qs] + list(properties.values()), conn=_conn, notify=properties))
 
             @classmethod
             async def delete_all(cls, _conn=None, **properties):
                 """Deletes all matching Models from the database."""
                 if not properties:
                     raise ValueError("delete_all() requires at least one keyword argument!")
-                qs = f"DELETE FROM {cls.__schemaname__}.{cls.__tablename__} WHERE " + " AND ".join(
-                    f"{f}=${i}" for i, f in enumerate(properties.keys(), 1))
-                return await cls.fetch(*([qs] + list(properties.values())), _conn=_conn)
+                qs = cls._sql("delete", tuple(properties.keys()))
+                return cls.from_records(await cls._fetch([qs] + list(properties.values()), conn=_conn, notify=properties))
 
             def primary_key(self):
                 """Returns the primary key tuple of the table."""
@@ -223,33 +631,243 @@ class ORM:
                 """Regurns the fully qualified table name of the Model."""
                 return f"{cls.__schemaname__}.{cls.__tablename__}"
 
-            async def upsert(self, conn=None, retry=5):
-                """This performs an upsert by doing a select then an insert/update, this can be subject to race conditions
-                and should be avoided if possible."""
-
-                exc = None
-                for i in range(retry):
-                    try:
-                        if not self.__primary_key__:
-                            # ig i could implement a checker?
-                            raise TypeError("upsert() requires a primary key on the table")
-                        if await self.select_one(**{k: getattr(self, k) for k in self.__primary_key__}, _conn=conn):
-                            await self.update(_conn=conn)
-                        else:
-                            await self.insert(_conn=conn)
-                        return
-                    except asyncpg.UniqueViolationError as e:
-                        exc = e
-                        # oops!
-                raise exc
+            async def upsert(self, conn=None):
+                """Inserts the Model, or updates the row with the same primary key if one exists, in a single
+                INSERT ... ON CONFLICT statement. The Model is refreshed with the row as stored in the database."""
+                if not self.__primary_key__:
+                    raise TypeError("upsert() requires a primary key on the table")
+                if any(getattr(self, k) is None for k in self.__primary_key__):
+                    # a missing key is left for the database (serial columns) to fill in, so there's nothing to conflict with
+                    return await self.insert(_conn=conn)
+
+                fields = tuple(self._columns.keys())
+                qs = self._sql("upsert", fields, " RETURNING *")
+                record = await self._fetch([qs] + [getattr(self, f) for f in fields], _one=True, conn=conn, notify=self._identity())
+                if record is not None:
+                    for field in fields:
+                        setattr(self, field, record[field])
+                return None
+
+            def _identity(self):
+                """Returns the fields identifying this Model's row: the primary key if there is one, otherwise everything."""
+                return {k: getattr(self, k) for k in (self.__primary_key__ or self._columns.keys())}
+
+            @classmethod
+            async def _notify(cls, keys, conn=None):
+                """Tells every process listening on the database that rows matching keys in this table were written."""
+                await cls._orm.notify_write(cls.table_name(), keys, conn=conn)
 
+        # lets Models find their ORM before create_all_tables has run, e.g. when caches register for invalidations
+        Model._orm = self
         self.Model = Model
-        self.acquire = None
         self.pool: asyncpg.pool.Pool
-
-    async def join(self, tables, tnames, join_on, where=None, addn_sql="", params=None, use_dict=True):
+        # seconds to wait for a pooled connection before giving up, or None to wait forever
+        self.acquire_timeout = None
+        # acquires waiting at least this many seconds are logged
+        self.acquire_warn_threshold = 0.5
+        self.pool_stats = PoolStats()
+        # optional pool on a read replica that select(), fetch() and join() use by default
+        self.replica_pool = None
+        self.replica_pool_stats = PoolStats()
+        # channel that writes are announced on through NOTIFY, so other processes can drop stale cache entries
+        self.notify_channel = None
+        self._listen_conn = None
+        # asyncpg.connect arguments for (re)opening the LISTEN connection
+        self._listen_kwargs = {}
+        self._relisten_task = None
+        self._invalidation_listeners = []
+        # (model name, normalised sql) -> QueryStats
+        self.query_stats = {}
+        # raw sql -> normalised sql, since the same few statements are recorded over and over
+        self._normalised_sql = {}
+        # _normalised_sql is cleared past this many entries, in case some query inlines its values
+        self.normalised_sql_cache_size = 4096
+        # queries taking at least this many seconds are logged
+        self.slow_query_threshold = 0.5
+        self._query_hooks = []
+        # (join query, row classes) -> (result column names, per-table column offsets), so rows are split by index instead
+        # of by name. The row classes are part of the key because create_all_tables replaces them on every cog reload.
+        self._join_plans = {}
+        # _join_plans is cleared past this many entries
+        self.join_plan_cache_size = 256
+
+    def add_query_hook(self, hook):
+        """Registers hook(model_name, sql, elapsed, rows, pool_wait, failed) to be called after every ORM query."""
+        self._query_hooks.append(hook)
+
+    def remove_query_hook(self, hook):
+        """Unregisters a query hook."""
+        self._query_hooks.remove(hook)
+
+    def record_query(self, model_name, sql, elapsed, rows, pool_wait, *, failed=False):
+        """Records the timing of a query, logs it if it was slow and passes it on to the query hooks."""
+        raw_sql = sql
+        sql = self._normalised_sql.get(raw_sql)
+        if sql is None:
+            if len(self._normalised_sql) >= self.normalised_sql_cache_size:
+                self._normalised_sql.clear()
+            sql = self._normalised_sql[raw_sql] = _sql_literal_re.sub("?", " ".join(raw_sql.split()))
+        key = (model_name, sql)
+        stats = self.query_stats.get(key)
+        if stats is None:
+            stats = self.query_stats[key] = QueryStats(raw_sql)
+        stats.add(elapsed, rows, pool_wait, failed)
+        if elapsed >= self.slow_query_threshold:
+            logger.warning(f"Slow query from {model_name} took {elapsed * 1000:.1f}ms (+{pool_wait * 1000:.1f}ms pool wait): {sql}")
+        for hook in self._query_hooks:
+            hook(model_name, sql, elapsed, rows, pool_wait, failed)
+
+    def query_stats_snapshot(self, sort_by="total", limit=None):
+        """Returns a list of per-statement stats dicts (with "model" and "sql" keys), heaviest first."""
+        ret = []
+        for (model_name, sql), stats in self.query_stats.items():
+            ent = stats.snapshot()
+            ent["model"] = model_name
+            ent["sql"] = sql
+            ret.append(ent)
+        ret.sort(key=lambda ent: ent[sort_by], reverse=True)
+        return ret[:limit] if limit else ret
+
+    def reset_query_stats(self):
+        """Clears all recorded query stats."""
+        self.query_stats.clear()
+
+    async def explain(self, sql):
+        """Returns the lines of the generic plan postgres would use for a statement, without running it.
+        $n parameters are left unbound, so the plan is the one that is used for any values (requires postgres 12+)."""
+        params = max(map(int, _sql_param_re.findall(sql)), default=0)
+        async with self.acquire() as conn:
+            await conn.execute("SET plan_cache_mode = force_generic_plan")
+            try:
+                await conn.execute(f"PREPARE dozer_explain AS {sql}")
+                try:
+                    rows = await conn.fetch("EXPLAIN EXECUTE dozer_explain" + (f"({', '.join(['NULL'] * params)})" if params else ""))
+                finally:
+                    await conn.execute("DEALLOCATE dozer_explain")
+            finally:
+                await conn.execute("RESET plan_cache_mode")
+        return [r[0] for r in rows]
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, replica=False):
+        """Acquires a connection from the pool, recording how long it took. Use with async with.
+        With replica set, the connection comes from the read replica's pool if one is configured."""
+        if replica and self.replica_pool is not None:
+            pool, stats, name = self.replica_pool, self.replica_pool_stats, "replica"
+        else:
+            pool, stats, name = self.pool, self.pool_stats, "primary"
+        start = time.perf_counter()
+        stats.waiters += 1
+        try:
+            conn = await pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            logger.error(f"Timed out acquiring a {name} database connection after {self.acquire_timeout}s "
+                         f"({pool.get_size() - pool.get_idle_size()} in use, {stats.waiters - 1} other waiters)")
+            raise
+        finally:
+            stats.waiters -= 1
+        wait = time.perf_counter() - start
+        stats.add(wait)
+        if wait >= self.acquire_warn_threshold:
+            stats.slow_acquires += 1
+            logger.warning(f"Waited {wait * 1000:.0f}ms for a {name} database connection "
+                           f"({pool.get_size() - pool.get_idle_size()} in use, {stats.waiters} still waiting)")
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    def pool_status(self, replica=False):
+        """Returns the pool's size, usage and acquire stats as a dict, or None if replica is set and there's no replica."""
+        if replica:
+            return self.replica_pool_stats.snapshot(self.replica_pool) if self.replica_pool is not None else None
+        return self.pool_stats.snapshot(self.pool)
+
+    def add_invalidation_listener(self, callback):
+        """Registers callback(table_name, keys) to be called whenever any process writes rows matching keys to a table.
+        An empty keys dict means any row of the table may have changed, and a table_name of None means any row of any table
+        may have (e.g. after notices were missed while the LISTEN connection was down).
+        Only a weak reference is kept, so listeners go away with their owners (e.g. on cog reload)."""
+        if hasattr(callback, "__self__"):
+            self._invalidation_listeners.append(weakref.WeakMethod(callback))
+        else:
+            self._invalidation_listeners.append(weakref.ref(callback))
+
+    def dispatch_invalidation(self, table, keys):
+        """Calls every live invalidation listener."""
+        live = []
+        for ref in self._invalidation_listeners:
+            callback = ref()
+            if callback is None:
+                continue
+            live.append(ref)
+            try:
+                callback(table, keys)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception(f"Invalidation listener {callback} failed")
+        self._invalidation_listeners = live
+
+    async def notify_write(self, table, keys, conn=None):
+        """Announces a write to table on the notify channel. Inside a transaction, the notice is only sent on commit."""
+        if self.notify_channel is None:
+            return
+        payload = json.dumps({"table": table, "keys": keys}, default=str)
+        if conn is None:
+            async with self.acquire() as conn:
+                await conn.execute("SELECT pg_notify($1, $2)", self.notify_channel, payload)
+        else:
+            await conn.execute("SELECT pg_notify($1, $2)", self.notify_channel, payload)
+
+    def _on_notify(self, conn, pid, channel, payload):  # pylint: disable=unused-argument
+        """asyncpg LISTEN callback."""
+        try:
+            notice = json.loads(payload)
+            table, keys = notice["table"], notice["keys"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Ignoring malformed invalidation notice {payload!r}")
+            return
+        self.dispatch_invalidation(table, keys)
+
+    async def _listen(self):
+        """Opens the connection that LISTENs for invalidation notices."""
+        conn = await asyncpg.connect(**self._listen_kwargs)
+        try:
+            await conn.add_listener(self.notify_channel, self._on_notify)
+        except BaseException:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_listen_lost)
+        self._listen_conn = conn
+
+    def _on_listen_lost(self, conn):  # pylint: disable=unused-argument
+        """asyncpg termination callback for the LISTEN connection."""
+        logger.warning("Lost the invalidation LISTEN connection, dropping everything cached and reconnecting")
+        self._listen_conn = None
+        self.dispatch_invalidation(None, {})
+        self._relisten_task = asyncio.ensure_future(self._relisten())
+
+    async def _relisten(self, max_delay=60):
+        """Reopens the LISTEN connection, backing off between failed attempts."""
+        delay = 1
+        while self.notify_channel is not None:
+            try:
+                await self._listen()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f"Couldn't reopen the invalidation LISTEN connection, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+            # writes made while nobody was listening went unannounced, and may have been cached in the meantime
+            self.dispatch_invalidation(None, {})
+            logger.info("Reopened the invalidation LISTEN connection")
+            break
+        self._relisten_task = None
+
+    async def join(self, tables, tnames, join_on, where=None, addn_sql="", params=None, use_dict=True, *, primary=False):
         """Performs black magic to perform a join. I don't even remember how this works anymore.
         tables, tnames, and on are NOT injection safe!
+        Runs on the read replica if there is one, unless primary is set.
         """
         if len(tables) != (len(join_on) + 1) or len(tables) != len(tnames):
             raise TypeError("tables not same length as join_on")
@@ -265,54 +883,82 @@ class ORM:
         if not params:
             params = tuple()
         qs = f"SELECT {qs_tables} FROM {tables[0].table_name()} AS {tnames[0]} {qs_joins} {qs_where} {addn_sql}"
-        async with self.pool.acquire() as conn:
+        start = time.perf_counter()
+        async with self.acquire(replica=not primary) as conn:
+            acquired = time.perf_counter()
             rows = await conn.fetch(qs, *params)
-
+        self.record_query("join", qs, time.perf_counter() - acquired, len(rows), acquired - start)
+
+        if not rows:
+            return []
+
+        keys = tuple(rows[0].keys())
+        plan_key = (qs, tuple(table._row_class for table in tables))
+        cached = self._join_plans.get(plan_key)
+        if cached is not None and cached[0] == keys:
+            plan = cached[1]
+        else:
+            # the '.' columns separate the tables; each table's fields are found by name once, within its own slice
+            bounds = [-1] + [i for i, k in enumerate(keys) if k == '.'] + [len(keys)]
+            plan = [(table._row_class, table._record_setters(keys[lo + 1:hi], lo + 1))
+                    for table, lo, hi in zip(tables, bounds, bounds[1:])]
+            if len(self._join_plans) >= self.join_plan_cache_size:
+                self._join_plans.clear()
+            self._join_plans[plan_key] = (keys, plan)
+
+        new = object.__new__
         ret = []
         for row in rows:
-            t_idx = 0
-            obj_data = {}
-            ret_row = {} if use_dict else []
-            for column_name, value in row.items():
-                if column_name == '.':
-                    if use_dict:
-                        ret_row[tnames[t_idx]] = tables[t_idx].from_record(obj_data)
-                    else:
-                        ret_row.append(tables[t_idx].from_record(obj_data))
-                    t_idx += 1
-                    obj_data = {}
-                else:
-                    obj_data[column_name] = value
-
-            if use_dict:
-                ret_row[tnames[t_idx]] = tables[t_idx].from_record(obj_data)
-            else:
-                ret_row.append(tables[t_idx].from_record(obj_data))
-
-            if use_dict:
-                ret.append(ret_row)
-            else:
-                ret.append(tuple(ret_row))
+            objs = []
+            for row_cls, setters in plan:
+                obj = new(row_cls)
+                obj.conn = None
+                for set_field, idx in setters:
+                    set_field(obj, row[idx])
+                objs.append(obj)
+            ret.append(dict(zip(tnames, objs)) if use_dict else tuple(objs))
         return ret
 
 
-    async def connect(self, **kwargs):
-        """Connects to the database and creates the internal asyncpg pool."""
-        async def connection_initer(conn):
-            await conn.set_type_codec(
-                'json',
-                encoder=json.dumps,
-                decoder=json.loads,
-                schema='pg_catalog'
-            )
-
-        kwargs["init"] = connection_initer
+    async def connect(self, notify_channel="dozer_invalidate", acquire_timeout=None, acquire_warn_threshold=0.5, replica_dsn=None,
+                      json_codec=None, **kwargs):
+        """Connects to the database and creates the internal asyncpg pool.
+        If replica_dsn is given, a second pool with the same settings is created on that read replica for select()/fetch()/join().
+        json_codec is the JSONCodec used for json and jsonb columns, by default orjson if it's installed and the json module if not.
+        Unless notify_channel is None, a dedicated connection (with the same connection settings) also LISTENs for writes
+        made by other processes. If it's lost, everything cached is invalidated and it's reopened in the background.
+        Other kwargs (min_size, max_size, max_inactive_connection_lifetime, statement_cache_size...) go to asyncpg.create_pool."""
+        kwargs["init"] = (json_codec or default_json_codec).register
+        self.acquire_timeout = acquire_timeout
+        self.acquire_warn_threshold = acquire_warn_threshold
         self.pool = await asyncpg.create_pool(**kwargs)
-        self.acquire = self.pool.acquire
+        if replica_dsn is not None:
+            self.replica_pool = await asyncpg.create_pool(**dict(kwargs, dsn=replica_dsn))
+
+        if notify_channel is not None:
+            self.notify_channel = notify_channel
+            self._listen_kwargs = {k: v for k, v in kwargs.items() if k not in _pool_only_kwargs}
+            try:
+                await self._listen()
+            except BaseException:
+                self.notify_channel = None
+                raise
 
 
     async def close(self):
-        """Shuts down the asyncpg pool."""
+        """Shuts down the asyncpg pools."""
+        self.notify_channel = None
+        if self._relisten_task is not None:
+            self._relisten_task.cancel()
+            self._relisten_task = None
+        if self._listen_conn is not None:
+            # closing it ourselves shouldn't look like losing it
+            self._listen_conn.remove_termination_listener(self._on_listen_lost)
+            await self._listen_conn.close()
+            self._listen_conn = None
+        if self.replica_pool is not None:
+            await self.replica_pool.close()
+            self.replica_pool = None
         await self.pool.close()
 
 orm = ORM()
@@ -0,0 +1,75 @@
+"""Keeps a whole table in memory as a dict, for lookups that happen too often to query for (e.g. on every reaction)."""
+import asyncio
+
+
+class TableIndex:
+    """A dict over one table, loaded on first use and kept up to date through the ORM's invalidation notices.
+
+    load_all: coroutine function returning the full dict
+    load_one: coroutine function returning the value for one key, or None if there's nothing for it anymore
+    key_field: the column the dict is keyed on. Writes to rows with a known key_field only mark that key stale, to be
+    reloaded on its next lookup; any other write to the table reloads everything, unless table_wide_reloads is False
+    (for tables whose unkeyed writes never touch what's indexed). Missed notices always reload everything.
+    """
+    def __init__(self, table, key_field, load_all, load_one, table_wide_reloads=True):
+        self.table = table
+        self.key_field = key_field
+        self._load_all = load_all
+        self._load_one = load_one
+        self.table_wide_reloads = table_wide_reloads
+        self.data = {}
+        # keys written to (possibly by another process) since they were loaded
+        self._stale = set()
+        self._load = None
+        table._orm.add_invalidation_listener(self._on_invalidation)
+
+    async def load(self):
+        """Loads the table, if that hasn't happened yet. Concurrent calls share one load."""
+        if self._load is None:
+            self._load = asyncio.ensure_future(self._load_data())
+        await asyncio.shield(self._load)
+
+    async def _load_data(self):
+        # cleared first, so that anything invalidated while this loads is still reloaded afterwards
+        self._stale.clear()
+        try:
+            self.data = await self._load_all()
+        except Exception:
+            self._load = None
+            raise
+
+    async def get(self, key, default=None):
+        """Returns the value for key, reloading it first if it's stale."""
+        await self.load()
+        if key in self._stale:
+            self._stale.discard(key)
+            value = await self._load_one(key)
+            if value is not None:
+                self.data[key] = value
+            else:
+                self.data.pop(key, None)
+        return self.data.get(key, default)
+
+    async def contains(self, key):
+        """Returns whether there's a value for key, counting stale keys as present."""
+        await self.load()
+        return key in self.data or key in self._stale
+
+    def set(self, key, value):
+        """Records a value written by this process."""
+        self.data[key] = value
+
+    def pop(self, key, default=None):
+        """Forgets a key deleted by this process."""
+        self._stale.discard(key)
+        return self.data.pop(key, default)
+
+    def _on_invalidation(self, table_name, keys):
+        """Marks keys written to by this or any other process as needing a reload."""
+        if table_name is None:
+            self._load = None
+        elif table_name == self.table.table_name():
+            if self.key_field in keys:
+                self._stale.add(keys[self.key_field])
+            elif self.table_wide_reloads:
+                self._load = None
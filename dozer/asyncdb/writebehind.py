@@ -0,0 +1,153 @@
+"""Buffers high-frequency writes (counters, last-write-wins updates) and flushes them to postgres in batches."""
+import asyncio
+import copy
+import logging
+
+logger = logging.getLogger("dozer")
+
+
+class WriteBehindBuffer:
+    """Coalesces frequent writes per primary key and flushes them in batches.
+
+    Increments to the same row are summed, and updates to the same row keep only the latest version, so a burst of
+    events turns into one batched statement per table. Pending writes are flushed every `interval` seconds, as soon as
+    `max_pending` rows are waiting, and on close(). Only one flush runs at a time, so a later version of a row is never
+    written before an earlier one.
+    """
+    def __init__(self, interval=5.0, max_pending=500):
+        self.interval = interval
+        self.max_pending = max_pending
+        # (table name, primary key) -> (row, {field: delta})
+        self._increments = {}
+        # (table name, primary key) -> row
+        self._upserts = {}
+        # timer handle for the next interval flush
+        self._flush_timer = None
+        # flushes that have been started, but not finished yet
+        self._flush_tasks = set()
+        # whether a started flush is still waiting for its turn, in which case it'll pick up new rows too
+        self._flush_queued = False
+        # created on first use, so that it belongs to the running event loop
+        self._flush_lock = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.writes_coalesced = 0
+        self.rows_dropped = 0
+
+    @staticmethod
+    def _key(row):
+        if not row.__primary_key__:
+            raise TypeError(f"{row.__class__.__name__} needs a primary key to be buffered")
+        return row.table_name(), row.primary_key()
+
+    def increment(self, row, **deltas):
+        """Queues adding deltas to fields of row. If the row doesn't exist yet, it's inserted with the deltas as values."""
+        key = self._key(row)
+        entry = self._increments.get(key)
+        if entry is None:
+            self._increments[key] = (copy.copy(row), dict(deltas))
+        else:
+            self.writes_coalesced += 1
+            for field, delta in deltas.items():
+                entry[1][field] = entry[1].get(field, 0) + delta
+        self._schedule()
+
+    def upsert(self, row):
+        """Queues an upsert of row as it is now. A later upsert of the same row replaces this one."""
+        key = self._key(row)
+        if key in self._upserts:
+            self.writes_coalesced += 1
+        self._upserts[key] = copy.copy(row)
+        self._schedule()
+
+    def pending_increment(self, row, field):
+        """Returns how much is waiting to be added to a field of row."""
+        entry = self._increments.get(self._key(row))
+        return entry[1].get(field, 0) if entry else 0
+
+    async def discard(self, row):
+        """Drops any pending writes for row, e.g. because it's about to be deleted.
+        Waits for a flush in progress first, so that the row can't be written back after it's deleted."""
+        key = self._key(row)
+        async with self._lock():
+            self._increments.pop(key, None)
+            self._upserts.pop(key, None)
+
+    @property
+    def pending(self):
+        """Number of rows waiting to be written."""
+        return len(self._increments) + len(self._upserts)
+
+    def _lock(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    def _schedule(self):
+        if self.pending >= self.max_pending:
+            self._start_flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_event_loop().call_later(self.interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_queued:
+            return
+        self._flush_queued = True
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        """Writes everything that's pending, after any flush that's already running."""
+        async with self._lock():
+            self._flush_queued = False
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            increments, self._increments = self._increments, {}
+            upserts, self._upserts = self._upserts, {}
+            if increments or upserts:
+                await self._write(increments, upserts)
+
+    async def _write(self, increments, upserts):
+        self.flushes += 1
+
+        # rows are batched per table, and for increments also per set of incremented fields since that changes the query
+        batches = {}
+        for row, deltas in increments.values():
+            for field, delta in deltas.items():
+                setattr(row, field, delta)
+            batches.setdefault((row.table_name(), tuple(sorted(deltas))), []).append(row)
+        for row in upserts.values():
+            batches.setdefault((row.table_name(), None), []).append(row)
+
+        for (table_name, counters), rows in batches.items():
+            model = type(rows[0])
+            try:
+                if counters is None:
+                    await model.upsert_many(rows)
+                else:
+                    await model.increment_many(rows, counters)
+                self.rows_written += len(rows)
+            except Exception:  # pylint: disable=broad-except
+                self.rows_dropped += len(rows)
+                logger.exception(f"Dropped {len(rows)} buffered writes to {table_name}")
+
+    async def close(self):
+        """Waits for running flushes, then writes everything that's still pending. Call before closing the ORM."""
+        if self._flush_tasks:
+            await asyncio.wait(self._flush_tasks)
+        await self.flush()
+
+    def stats(self):
+        """Returns the pending row count and flush counters."""
+        return {
+            "pending": self.pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "writes_coalesced": self.writes_coalesced,
+            "rows_dropped": self.rows_dropped,
+        }
+
+
+write_behind = WriteBehindBuffer()
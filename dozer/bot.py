@@ -10,6 +10,8 @@ from discord.ext import commands
 
 from . import utils
 from .asyncdb.orm import orm
+from .asyncdb.writebehind import write_behind
+from .logsink import log_sink
 
 # why on earth should logging objects be capitalized?
 dozer_logger = logging.getLogger('dozer')
@@ -168,7 +170,9 @@ class Dozer(commands.Bot):
         """Shuts down the bot"""
         self._restarting = restart
         #await self.logout()
+        await log_sink.close()
         await self.close()
+        await write_behind.close()
         await orm.close()
         await self.http_session.close()
         self.loop.stop()
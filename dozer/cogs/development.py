@@ -8,6 +8,7 @@ from discord.ext.commands import NotOwner
 
 from ._utils import *
 from ..asyncdb.orm import orm
+from ..logsink import log_sink
 
 logger = logging.getLogger("dozer")
 
@@ -61,6 +62,104 @@ class Development(Cog):
     `{prefix}reload development` - reloads the development cog
     """
 
+    @command()
+    async def querystats(self, ctx, limit: int = 10):
+        """Shows the database queries that have taken the most total time since startup (or the last reset)."""
+        stats = orm.query_stats_snapshot(limit=limit)
+        if not stats:
+            await ctx.send("No queries have been recorded yet.")
+            return
+        await self.line_print(ctx, f"Top {len(stats)} queries by total time", (
+            f"**{ent['model']}**: {ent['count']} calls ({ent['errors']} failed), {ent['total'] * 1000:.0f}ms total, "
+            f"p50 {ent['p50'] * 1000:.1f}ms / p99 {ent['p99'] * 1000:.1f}ms / max {ent['max'] * 1000:.1f}ms, "
+            f"{ent['rows']} rows, {ent['pool_wait'] * 1000:.0f}ms pool wait\n`{ent['sql'][:300]}`"
+            for ent in stats), color=discord.Color.blue())
+
+    querystats.example_usage = """
+    `{prefix}querystats` - show the 10 database queries that have taken the most time
+    `{prefix}querystats 25` - show the top 25
+    """
+
+    @command()
+    async def resetquerystats(self, ctx):
+        """Clears the recorded database query stats."""
+        orm.reset_query_stats()
+        await ctx.send("Query stats reset.")
+
+    resetquerystats.example_usage = """
+    `{prefix}resetquerystats` - start recording query stats from scratch
+    """
+
+    @command()
+    async def explainqueries(self, ctx, limit: int = 10):
+        """Shows postgres's plans for the database queries that have taken the most total time, flagging sequential scans.
+        Sequential scans of small tables are normal; on big ones they usually mean a missing index."""
+        stats = [ent for ent in orm.query_stats_snapshot()
+                 if ent['example'].lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH"))][:limit]
+        if not stats:
+            await ctx.send("No queries have been recorded yet.")
+            return
+        lines = []
+        for ent in stats:
+            try:
+                plan = await orm.explain(ent['example'])
+            except Exception as e:  # the query may reference a dropped table, need postgres 12+, etc.
+                lines.append(f"**{ent['model']}**: couldn't explain ({e})\n`{ent['sql'][:300]}`")
+                continue
+            seq_scans = [line.strip() for line in plan if "Seq Scan" in line]
+            flag = "⚠️ " + "; ".join(seq_scans) if seq_scans else "✅ no sequential scans"
+            lines.append(f"**{ent['model']}**: {ent['count']} calls, {ent['total'] * 1000:.0f}ms total - {flag}\n`{ent['sql'][:300]}`")
+        await self.line_print(ctx, f"Plans for the top {len(stats)} queries", lines, color=discord.Color.blue())
+
+    explainqueries.example_usage = """
+    `{prefix}explainqueries` - check the plans of the 10 database queries that have taken the most time for sequential scans
+    `{prefix}explainqueries 25` - check the top 25
+    """
+
+    @command()
+    async def poolstats(self, ctx):
+        """Shows the database connection pools' usage and acquire latency."""
+        for name, status in (("Database pool", orm.pool_status()), ("Replica pool", orm.pool_status(replica=True))):
+            if status is None:
+                continue
+            e = discord.Embed(title=name, color=discord.Color.blue())
+            e.add_field(name="Connections", value=f"{status['in_use']} in use, {status['idle']} idle "
+                                                  f"({status['min_size']}-{status['max_size']})")
+            e.add_field(name="Waiters", value=status['waiters'])
+            e.add_field(name="Acquires", value=f"{status['acquires']} ({status['slow_acquires']} slow, {status['timeouts']} timed out)")
+            e.add_field(name="Acquire latency", value="\n".join(f"{bucket}: {count}" for bucket, count in status['acquire_latency'].items()),
+                        inline=False)
+            await ctx.send(embed=e)
+
+    poolstats.example_usage = """
+    `{prefix}poolstats` - show how busy the database connection pools are
+    """
+
+    @command()
+    async def timerstats(self, ctx):
+        """Shows how many punishment timers are queued and when the next one runs out."""
+        stats = ctx.bot.cogs['Moderation'].punishments.stats()
+        next_in = f"in {stats['next_in']:.0f}s" if stats['next_in'] is not None else "none queued"
+        await ctx.send(f"{stats['depth']} punishment timers queued ({stats['heap_size']} heap entries), next {next_in}. "
+                       f"{stats['finished']} finished and {stats['cancelled']} cancelled since startup.")
+
+    timerstats.example_usage = """
+    `{prefix}timerstats` - show the depth of the punishment timer queue
+    """
+
+    @command()
+    async def logstats(self, ctx):
+        """Shows how many log embeds are waiting to be sent, and how many were sent, dropped or failed."""
+        stats = log_sink.stats()
+        busiest = ", ".join(f"<#{channel_id}>: {depth}" for depth, channel_id in stats['busiest']) or "none"
+        await ctx.send(f"{stats['queued']} log embeds queued (busiest channels: {busiest}). "
+                       f"{stats['embeds_sent']} sent in {stats['messages_sent']} messages, "
+                       f"{stats['embeds_dropped']} dropped from full queues and {stats['embeds_failed']} failed to send.")
+
+    logstats.example_usage = """
+    `{prefix}logstats` - show the depth of the log embed queues
+    """
+
     @command(name='eval')
     async def evaluate(self, ctx, *, code):
         """
@@ -1,5 +1,6 @@
 """Provides moderation commands for Dozer."""
 import asyncio
+import heapq
 import re
 import datetime
 import time
@@ -12,6 +13,7 @@ from discord.ext.commands import BadArgument, has_permissions, RoleConverter, gu
 from ._utils import *
 from ..asyncdb.orm import orm
 from ..asyncdb import psqlt, configcache
+from ..logsink import log_sink
 
 class SafeRoleConverter(RoleConverter):
     """Allows for @everyone to be specified without pinging everyone"""
@@ -33,6 +35,17 @@ class Moderation(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.guild_config = GuildConfig.get_cache(bot) #configcache.AsyncConfigCache(GuildConfig)
+        self.punishments = PunishmentScheduler(self)
+        if bot.is_ready():
+            # reloaded cogs don't get on_ready, so the stored timers have to be picked up here
+            bot.loop.create_task(self.punishments.load())
+        # guild id -> LinkPolicy, or None if anyone may post links there
+        self.link_policies = {}
+        orm.add_invalidation_listener(self._on_invalidation)
+
+    def cog_unload(self):
+        """Stops the punishment scheduler. The timers stay in the database, and the reloaded cog loads them again."""
+        self.punishments.stop()
 
     """=== Helper functions ==="""
 
@@ -60,7 +73,7 @@ class Moderation(Cog):
             if global_modlog:
                 channel = actor.guild.get_channel(config.mod_log_channel_id)
                 if channel is not None and channel != orig_channel:  # prevent duplicate embeds
-                    await channel.send(embed=modlog_embed)
+                    log_sink.send(channel, modlog_embed)
         else:
             if orig_channel is not None:
                 await orig_channel.send("Please configure modlog channel to enable modlog functionality")
@@ -91,13 +104,12 @@ class Moderation(Cog):
         return (hours * 3600) + (minutes * 60) + seconds
 
     async def punishment_timer(self, seconds, target: discord.Member, punishment, reason, actor: discord.Member, orig_channel=None,
-                               global_modlog=True):
-        """Asynchronous task that sleeps for a set time to unmute/undeafen a member for a set period of time."""
+                               global_modlog=True, _conn=None):
+        """Registers a timer to unmute/undeafen a member after a set period of time."""
         if seconds == 0:
             return
 
-        # register the timer
-        ent = PunishmentTimerRecord(
+        record = PunishmentTimerRecord(
             guild_id=target.guild.id,
             actor_id=actor.id,
             target_id=target.id,
@@ -107,49 +119,77 @@ class Moderation(Cog):
             target_ts=int(seconds + time.time()),
             send_modlog=global_modlog
         )
-        ent_id = await ent.insert()
-
-        await asyncio.sleep(seconds)
+        record.id = await record.insert(_conn=_conn)
+        self.punishments.schedule(record)
+
+    async def finish_punishment(self, record):
+        """Lifts the punishment of a timer that ran out, and removes the timer."""
+        punishment = PunishmentTimerRecord.type_map[record.type]
+        guild = self.bot.get_guild(record.guild_id)
+        if guild is None:
+            # possibly just unavailable; the timer is left in the database for the next startup
+            getLogger('dozer').warning(f"Can't finish {punishment.__name__} timer {record.id}, guild {record.guild_id} not found")
+            return
 
-        user = await punishment.select_one(member_id=target.id, guild_id=target.guild.id)
+        user = await punishment.select_one(member_id=record.target_id, guild_id=record.guild_id)
         if user is not None:
-            await self.mod_log(actor,
-                               "un" + punishment.past_participle,
-                               target,
-                               reason,
-                               orig_channel,
-                               embed_color=discord.Color.green(),
-                               global_modlog=global_modlog)
-            self.bot.loop.create_task(punishment.finished_callback(self, target))
-        ent = await PunishmentTimerRecord.select_one(id=ent_id)
-        if ent:
-            await ent.delete()
+            target = guild.get_member(record.target_id)
+            if target is not None:
+                await self.mod_log(guild.get_member(record.actor_id) or guild.me,
+                                   "un" + punishment.past_participle,
+                                   target,
+                                   record.reason or "",
+                                   self.bot.get_channel(record.orig_channel_id),
+                                   embed_color=discord.Color.green(),
+                                   global_modlog=record.send_modlog)
+                self.bot.loop.create_task(punishment.finished_callback(self, target))
+            else:
+                # they left; make sure they don't get it back if they rejoin
+                await user.delete()
+        await record.delete()
 
     async def _check_links_warn(self, msg, role):
         """Warns a user that they can't send links."""
         warn_msg = await msg.channel.send(f"{msg.author.mention}, you need the `{role.name}` role to post links!", delete_after=3)
 
-    async def check_links(self, msg):
-        """Checks messages for the links role if necessary, then checks if the author is allowed to send links in the server"""
-        if msg.guild is None or not isinstance(msg.author, discord.Member) or not msg.guild.me.guild_permissions.manage_messages:
-            return
+    async def link_policy(self, guild):
+        """Returns the guild's LinkPolicy, or None if anyone may post links there. Built from the guild config on first use."""
+        try:
+            return self.link_policies[guild.id]
+        except KeyError:
+            pass
+        config: GuildConfig = await self.guild_config.query_one(guild_id=guild.id)
+        if config is None or config.links_role_id is None or config.links_role_id == guild.id:
+            policy = None
+        else:
+            policy = LinkPolicy(config.links_role_id)
+        self.link_policies[guild.id] = policy
+        return policy
 
-        # this is a dirty hack
-        # (let people post links in #robotics-help, #media, #robot-showcase)
-        if msg.channel.id in [676583549561995274, 771188718198456321, 761068471252680704]:
+    def _on_invalidation(self, table_name, keys):
+        """Drops the link policies of guilds whose config was written to, by this or any other process."""
+        if table_name not in (None, GuildConfig.table_name()):
             return
+        if "guild_id" in keys:
+            self.link_policies.pop(keys["guild_id"], None)
+        else:
+            self.link_policies.clear()
 
-        config: GuildConfig = await self.guild_config.query_one(guild_id=msg.guild.id)
-        if config is None or config.links_role_id is None or config.links_role_id == msg.guild.id:
-            return
-        role = msg.guild.get_role(config.links_role_id)
+    async def check_links(self, msg):
+        """Checks messages for the links role if necessary, then checks if the author is allowed to send links in the server"""
+        # cheapest rejections first; most messages don't contain a link, and those never need the config
+        if msg.guild is None or not isinstance(msg.author, discord.Member) or not LinkPolicy.url_re.search(msg.content):
+            return False
+
+        policy = await self.link_policy(msg.guild)
+        if policy is None or policy.allows(msg) or not msg.guild.me.guild_permissions.manage_messages:
+            return False
+        role = msg.guild.get_role(policy.role_id)
         if role is None:
-            return
-        if role not in msg.author.roles and re.search("https?://", msg.content):
-            await msg.delete()
-            self.bot.loop.create_task(self._check_links_warn(msg, role))
-            return True
-        return False
+            return False
+        await msg.delete()
+        self.bot.loop.create_task(self._check_links_warn(msg, role))
+        return True
 
     """=== context-free backend functions ==="""
 
@@ -169,8 +209,7 @@ class Moderation(Cog):
                 await user.insert(_conn=conn, _upsert="ON CONFLICT DO NOTHING")
                 await self.perm_override(member, send_messages=False, add_reactions=False, speak=False)
 
-            self.bot.loop.create_task(
-                self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me, orig_channel=orig_channel))
+            await self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me, orig_channel=orig_channel, _conn=conn)
             return True
 
     async def _unmute(self, member: discord.Member):
@@ -179,6 +218,7 @@ class Moderation(Cog):
             user = await Mute.select_one(member_id=member.id, guild_id=member.guild.id, _conn=conn)
             if user is not None:
                 await user.delete(_conn=conn)
+                await self.punishments.cancel(member.guild.id, member.id, Mute)
                 await self.perm_override(member, send_messages=None, add_reactions=None, speak=None)
                 return True
             else:
@@ -204,13 +244,13 @@ class Moderation(Cog):
 
                 if self_inflicted and seconds == 0:
                     seconds = 30 # prevent lockout in case of bad argument
-                self.bot.loop.create_task(
-                    self.punishment_timer(seconds, member,
-                                          punishment=Deafen,
-                                          reason=reason,
-                                          actor=actor or member.guild.me,
-                                          orig_channel=orig_channel,
-                                          global_modlog=not self_inflicted))
+                await self.punishment_timer(seconds, member,
+                                            punishment=Deafen,
+                                            reason=reason,
+                                            actor=actor or member.guild.me,
+                                            orig_channel=orig_channel,
+                                            global_modlog=not self_inflicted,
+                                            _conn=conn)
                 return True
 
     async def _undeafen(self, member: discord.Member):
@@ -220,6 +260,7 @@ class Moderation(Cog):
             if user is not None:
                 await self.perm_override(member=member, read_messages=None, connect=None)
                 await user.delete(_conn=conn)
+                await self.punishments.cancel(member.guild.id, member.id, Deafen)
                 return True
             else:
                 return False
@@ -228,26 +269,16 @@ class Moderation(Cog):
 
     @Cog.listener()
     async def on_ready(self):
-        """Restore punishment timers on bot startup"""
-        async with orm.acquire() as conn:
-            q = await PunishmentTimerRecord.select(_conn=conn)
-            for r in q:
-                guild = self.bot.get_guild(r.guild_id)
-                actor = guild.get_member(r.actor_id)
-                target = guild.get_member(r.target_id)
-                orig_channel = self.bot.get_channel(r.orig_channel_id)
-                punishment_type = r.type
-                reason = r.reason or ""
-                seconds = max(int(r.target_ts - time.time()), 0.01)
-                await r.delete(_conn=conn)
-                self.bot.loop.create_task(self.punishment_timer(seconds,
-                                                                target,
-                                                                PunishmentTimerRecord.type_map[punishment_type],
-                                                                reason,
-                                                                actor,
-                                                                orig_channel=orig_channel,
-                                                                global_modlog=r.send_modlog))
-                getLogger('dozer').info(f"Restarted {PunishmentTimerRecord.type_map[punishment_type].__name__} of {target} in {guild}")
+        """Warm the guild config cache and restore punishment timers on bot startup"""
+        # one query for every guild, rather than a cache miss on the first message in each of them
+        await self.guild_config.preload("guild_id", [guild.id for guild in self.bot.guilds])
+
+        await self.punishments.load()
+
+    @Cog.listener()
+    async def on_guild_join(self, guild):
+        """Loads the config of a guild the bot was just added to."""
+        await self.guild_config.preload("guild_id", [guild.id])
 
     @Cog.listener()
     async def on_member_join(self, member):
@@ -260,7 +291,8 @@ class Moderation(Cog):
         config = await self.guild_config.query_one(guild_id=member.guild.id)
         if config is not None and config.member_log_channel_id is not None:
             channel = member.guild.get_channel(config.member_log_channel_id)
-            await channel.send(embed=join)
+            if channel is not None:
+                log_sink.send(channel, join)
 
         async with orm.acquire() as conn:
             user = await Mute.select_one(member_id=member.id, guild_id=member.guild.id, _conn=conn)
@@ -281,7 +313,8 @@ class Moderation(Cog):
         config = await self.guild_config.query_one(guild_id=member.guild.id)
         if config is not None and config.member_log_channel_id is not None:
             channel = member.guild.get_channel(config.member_log_channel_id)
-            await channel.send(embed=leave)
+            if channel is not None:
+                log_sink.send(channel, leave)
 
     @Cog.listener()
     async def on_message(self, message):
@@ -333,7 +366,7 @@ class Moderation(Cog):
         if config is not None and config.message_log_channel_id is not None:
             channel = message.guild.get_channel(config.message_log_channel_id)
             if channel is not None:
-                await channel.send(embed=e)
+                log_sink.send(channel, e)
 
     @Cog.listener()
     async def on_message_edit(self, before, after):
@@ -383,7 +416,7 @@ class Moderation(Cog):
             if config is not None and config.message_log_channel_id is not None:
                 channel = before.guild.get_channel(config.message_log_channel_id)
                 if channel is not None:
-                    await channel.send(embed=e)
+                    log_sink.send(channel, e)
 
     """=== Direct moderation commands ==="""
     @command()
@@ -737,6 +770,7 @@ class Moderation(Cog):
                 config.member_role_id = ctx.guild.id
             await config.update()
         self.guild_config.invalidate_entry(guild_id=ctx.guild.id)
+        self.link_policies.pop(ctx.guild.id, None)
         await ctx.send(f"Unset configuration for setting `{setting}`")
 
     unset.example_usage = """
@@ -813,6 +847,7 @@ class Moderation(Cog):
             raise BadArgument('Link role cannot be higher than your top role!')
 
         await GuildConfig.update_guild(ctx.guild, links_role_id=link_role.id)
+        self.link_policies.pop(ctx.guild.id, None)
         await ctx.send(f'Link role set as `{link_role.name}`.')
 
     linkscrubconfig.example_usage = """
@@ -866,6 +901,125 @@ class Moderation(Cog):
     `{prefix}serverconfig welcome #new-members` - Sets the invite channel to #new-members.
     """
 
+class LinkPolicy:
+    """A guild's compiled rules for who may post links where."""
+    __slots__ = ("role_id", "exempt_channels")
+    url_re = re.compile(r"https?://")
+    # this is a dirty hack
+    # (let people post links in #robotics-help, #media, #robot-showcase)
+    EXEMPT_CHANNELS = frozenset((676583549561995274, 771188718198456321, 761068471252680704))
+
+    def __init__(self, role_id, exempt_channels=EXEMPT_CHANNELS):
+        self.role_id = role_id
+        self.exempt_channels = exempt_channels
+
+    def allows(self, msg):
+        """Returns whether the author of a message containing a link may post it."""
+        # looks the role up by id rather than building and comparing the member's Role objects
+        return msg.channel.id in self.exempt_channels or msg.author.get_role(self.role_id) is not None
+
+
+class PunishmentScheduler:
+    """Runs every punishment timer from a single task, which sleeps until the earliest deadline in a min-heap.
+    Replaces having one task sleeping for the whole duration of each timed punishment."""
+
+    def __init__(self, cog):
+        self.cog = cog
+        # (target_ts, record id), earliest first. Cancelled timers are only dropped from here once they reach the top.
+        self._heap = []
+        # record id -> PunishmentTimerRecord, for the timers that are still live
+        self._records = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._loaded = False
+        self.finished = 0
+        self.cancelled = 0
+
+    @property
+    def depth(self):
+        """Number of timers waiting to run out."""
+        return len(self._records)
+
+    async def load(self):
+        """Schedules every timer stored in the database, streamed in one query. Only does anything the first time."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            async for record in PunishmentTimerRecord.iter_select():
+                self.schedule(record)
+        except Exception:
+            self._loaded = False
+            raise
+        getLogger('dozer').info(f"Restored {self.depth} punishment timers")
+
+    def schedule(self, record):
+        """Adds a (saved) PunishmentTimerRecord to the queue."""
+        if record.id in self._records:
+            return
+        self._records[record.id] = record
+        heapq.heappush(self._heap, (record.target_ts, record.id))
+        if self._heap[0][1] == record.id:
+            # new earliest deadline, so the runner has to recompute how long to sleep
+            self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def cancel(self, guild_id, target_id, punishment):
+        """Cancels and deletes a member's timers for a punishment, e.g. because it was lifted early."""
+        ids = [record_id for record_id, record in self._records.items()
+               if (record.guild_id, record.target_id, record.type) == (guild_id, target_id, punishment.type)]
+        for record_id in ids:
+            await self._records.pop(record_id).delete()
+        self.cancelled += len(ids)
+        if len(self._heap) > 2 * len(self._records) + 64:
+            # too many cancelled entries waiting to reach the top; rebuild without them
+            self._heap = [entry for entry in self._heap if entry[1] in self._records]
+            heapq.heapify(self._heap)
+
+    def stop(self):
+        """Stops running timers. They stay in the database and are picked up again by the next load()."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        """Returns the queue depth and counters."""
+        live = [entry for entry in self._heap if entry[1] in self._records]
+        return {
+            "depth": self.depth,
+            "heap_size": len(self._heap),
+            "next_in": max(min(live)[0] - time.time(), 0) if live else None,
+            "finished": self.finished,
+            "cancelled": self.cancelled,
+        }
+
+    async def _run(self):
+        while True:
+            while self._heap and self._heap[0][1] not in self._records:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, record_id = heapq.heappop(self._heap)
+            record = self._records.pop(record_id)
+            try:
+                await self.cog.finish_punishment(record)
+                self.finished += 1
+            except Exception:
+                getLogger('dozer').exception(f"Failed to finish punishment timer {record_id}")
+
+
 class GuildConfigCache(configcache.AsyncConfigCache):
     """we need an override so that query_one always returns a guild"""
 
@@ -878,12 +1032,29 @@ class GuildConfigCache(configcache.AsyncConfigCache):
         """always return a guild (and insert a new one if needed)"""
         if "guild_id" not in kwargs:
             raise ValueError("you probably want a guild_id defined")
-        guild_id = kwargs["guild_id"]
-        config = await super().query_one(**kwargs)
+        return await super().query_one(**kwargs)
+
+    # override
+    async def load_many(self, field, values):
+        """loads many guilds' configs, inserting the defaults for any that don't have one yet."""
+        configs = await super().load_many(field, values)
+        missing = [self.bot.get_guild(guild_id) for guild_id in set(values) - {config.guild_id for config in configs}]
+        missing = [guild for guild in missing if guild is not None]
+        if missing:
+            await GuildConfig.insert_many([GuildConfig.make_defaults(guild) for guild in missing], on_conflict="ON CONFLICT DO NOTHING")
+            configs += await super().load_many(field, [guild.id for guild in missing])
+        return configs
+
+    # override
+    async def load_one(self, **kwargs):
+        """loads a guild's config, inserting the defaults if there isn't one yet.
+        this runs once per cache miss no matter how many messages are waiting on it, so the defaults only get inserted once."""
+        config = await super().load_one(**kwargs)
         if config is None:
-            config = GuildConfig.make_defaults(self.bot.get_guild(guild_id))
+            config = GuildConfig.make_defaults(self.bot.get_guild(kwargs["guild_id"]))
             await config.insert(_upsert="ON CONFLICT DO NOTHING")
-            self.invalidate_entry(guild_id=guild_id)
+            # someone else may have gotten there first
+            config = await super().load_one(**kwargs) or config
         return config
 
 
@@ -982,19 +1153,13 @@ class GuildConfig(orm.Model):
     async def update_guild(cls, guild: discord.Guild, **kwargs):
         """update settings for a guild"""
         config = await cls._cache.query_one(guild_id=guild.id)
-
-        ins = False
         if config is None:
             config = GuildConfig.make_defaults(guild)
-            ins = True
         config.guild_name = guild.name
 
         for k, v in kwargs.items():
             setattr(config, k, v)
-        if ins:
-            await config.insert()
-        else:
-            await config.update()
+        await config.upsert()
         cls._cache.invalidate_entry(guild_id=guild.id)
 
 def setup(bot):
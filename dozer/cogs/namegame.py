@@ -16,6 +16,7 @@ from dozer.bot import dozer_logger
 from ._utils import *
 from ..asyncdb.orm import orm
 from ..asyncdb import psqlt
+from ..asyncdb.writebehind import write_behind
 
 SUPPORTED_MODES = ["frc", "ftc"]
 
@@ -665,11 +666,10 @@ class NameGame(Cog):
 
             record = await NameGameLeaderboard.select_one(user_id=winner.id, guild_id=ctx.guild.id, game_mode=game.mode)
             if record is None:
-                record = NameGameLeaderboard(user_id=winner.id, guild_id=ctx.guild.id, wins=1, game_mode=game.mode)
-                await record.insert()
-            else:
-                record.wins += 1
-                await record.update()
+                record = NameGameLeaderboard(user_id=winner.id, guild_id=ctx.guild.id, wins=0, game_mode=game.mode)
+            # the win is written in the background, so count any wins that haven't been flushed yet
+            record.wins += write_behind.pending_increment(record, "wins") + 1
+            write_behind.increment(record, wins=1)
             win_embed = discord.Embed()
             win_embed.color = discord.Color.gold()
             win_embed.title = "We have a winner!"
@@ -681,15 +681,8 @@ class NameGame(Cog):
             game.running = False
 
         if not game.running:
-            async with orm.acquire() as conn:
-                for team in game.picked:
-                    stats = await NameGameTeamStats.select_one(team_id=team, game_mode=game.mode, _conn=conn)
-                    if stats is None:
-                        stats = NameGameTeamStats(team_id=team, game_mode=game.mode, uses=1)
-                        await stats.insert(_conn=conn)
-                    else:
-                        stats.uses += 1
-                        await stats.update(_conn=conn)
+            for team in game.picked:
+                write_behind.increment(NameGameTeamStats(team_id=team, game_mode=game.mode), uses=1)
 
             self.games.pop(ctx.channel.id)
 
@@ -204,7 +204,7 @@ class News(Cog):
                 raise BadArgument(f"Data {data} is invalid. {e.args[0]}")
 
             search_exists = await NewsSubscription.get_by(channel_id=channel.id, source=source.short_name,
-                                                          data=str(data_obj))
+                                                          data=str(data_obj), _primary=True)
 
             if search_exists:
                 raise BadArgument(f"There is already a subscription of {source.full_name} with data {data} "
@@ -216,11 +216,11 @@ class News(Cog):
                 await ctx.send("Failed to add new data source. Please contact the Dozer Administrators.")
                 return
 
-            data_exists = await NewsSubscription.get_by(source=source.short_name, data=str(data_obj))
+            data_exists = await NewsSubscription.get_by(source=source.short_name, data=str(data_obj), _primary=True)
             if not data_exists:
                 await source.add_data(data_obj)
         else:
-            search_exists = await NewsSubscription.get_by(channel_id=channel.id, source=source.short_name)
+            search_exists = await NewsSubscription.get_by(channel_id=channel.id, source=source.short_name, _primary=True)
 
             if search_exists:
                 if search_exists[0].kind == kind:
@@ -265,7 +265,7 @@ class News(Cog):
                 return
 
             sub = await NewsSubscription.get_by(channel_id=channel.id, guild_id=channel.guild.id,
-                                                source=source.short_name, data=str(data_obj))
+                                                source=source.short_name, data=str(data_obj), _primary=True)
             if len(sub) == 0:
                 await ctx.send(f"No subscription of {source.full_name} for channel {channel.mention} with data "
                                f"{data_obj} found.")
@@ -277,7 +277,7 @@ class News(Cog):
                                f"with data {data} found. Please contact the Dozer administrator for help.")
                 return
 
-            data_exists = await NewsSubscription.get_by(source=source.short_name, data=str(data_obj))
+            data_exists = await NewsSubscription.get_by(source=source.short_name, data=str(data_obj), _primary=True)
             if len(data_exists) > 1:
                 removed = await source.remove_data(data_obj)
                 if not removed:
@@ -288,7 +288,7 @@ class News(Cog):
 
         else:
             sub = await NewsSubscription.get_by(channel_id=channel.id, guild_id=channel.guild.id,
-                                                source=source.short_name)
+                                                source=source.short_name, _primary=True)
             if len(sub) == 0:
                 raise BadArgument(f"No subscription of {source.full_name} for channel {channel.mention} found.")
 
@@ -428,6 +428,7 @@ class NewsSubscription(orm.Model):
     """Represents a single subscription of one news source to one channel"""
     __tablename__ = 'news_subs'
     __primary_key__ = ('id',)
+    __indexes__ = (('source',), ('guild_id', 'channel_id'))
 
     id: psqlt.Column("serial")
     channel_id: psqlt.Column("bigint NOT NULL")
@@ -8,7 +8,7 @@ from discord.ext.commands import cooldown, BucketType, has_permissions, BadArgum
 
 from ._utils import *
 from ..asyncdb.orm import orm
-from ..asyncdb import psqlt
+from ..asyncdb import psqlt, tableindex
 blurple = discord.Color.blurple()
 dozer_logger = logging.getLogger('dozer')
 
@@ -24,6 +24,47 @@ class Roles(Cog):
                 if await self.ctx_purge(ctx):
                     await ctx.send("Purged missing roles")
 
+        # message id -> {emoji: role id} for every message with reaction roles, and message id -> RoleMenu.
+        # loaded once, then kept up to date by the commands here and by invalidations for writes made elsewhere
+        self.reaction_roles = tableindex.TableIndex(ReactionRole, "message_id", self._load_reaction_roles,
+                                                    self._load_message_reaction_roles)
+        self.role_menus = tableindex.TableIndex(RoleMenu, "message_id", self._load_role_menus, self._load_role_menu)
+
+    @staticmethod
+    async def _load_reaction_roles():
+        reaction_roles = {}
+        for entry in await ReactionRole.select(_primary=True):
+            reaction_roles.setdefault(entry.message_id, {}).setdefault(entry.reaction, entry.role_id)
+        return reaction_roles
+
+    @staticmethod
+    async def _load_message_reaction_roles(message_id):
+        roles = {}
+        for entry in await ReactionRole.select(message_id=message_id, _primary=True):
+            roles.setdefault(entry.reaction, entry.role_id)
+        return roles or None
+
+    @staticmethod
+    async def _load_role_menus():
+        return {menu.message_id: menu for menu in await RoleMenu.select(_primary=True)}
+
+    @staticmethod
+    async def _load_role_menu(message_id):
+        return await RoleMenu.select_one(message_id=message_id)
+
+    def _index_reaction_role(self, entry):
+        """Records a reaction role in memory, replacing whatever emoji its role had on that message before."""
+        self._unindex_reaction_role(entry.message_id, entry.role_id)
+        self.reaction_roles.data.setdefault(entry.message_id, {})[entry.reaction] = entry.role_id
+
+    def _unindex_reaction_role(self, message_id, role_id):
+        """Forgets a reaction role."""
+        roles = self.reaction_roles.data.get(message_id, {})
+        for emoji in [emoji for emoji, rid in roles.items() if rid == role_id]:
+            del roles[emoji]
+        if not roles:
+            self.reaction_roles.pop(message_id)
+
     @staticmethod
     def normalize(name):
         """Normalizes a role for consistency in the DB."""
@@ -55,12 +96,22 @@ class Roles(Cog):
         """Removes a reaction from a message"""
         await message.clear_reaction(entry.reaction)
 
+    @Cog.listener()
+    async def on_ready(self):
+        """Loads the reaction roles so that reactions can be checked without a query."""
+        await self.reaction_roles.load()
+        await self.role_menus.load()
+
     @Cog.listener()
     async def on_raw_message_delete(self, payload):
         """Used to remove dead reaction role entries"""
         message_id = payload.message_id
-        await ReactionRole.delete(message_id=message_id)
-        await RoleMenu.delete(message_id=message_id)
+        if await self.reaction_roles.contains(message_id):
+            self.reaction_roles.pop(message_id)
+            await ReactionRole.delete(message_id=message_id)
+        if await self.role_menus.contains(message_id):
+            self.role_menus.pop(message_id)
+            await RoleMenu.delete(message_id=message_id)
 
     @Cog.listener()
     async def on_raw_reaction_add(self, payload):
@@ -75,12 +126,12 @@ class Roles(Cog):
     async def on_raw_reaction_action(self, payload):
         """Called whenever a reaction is added or removed"""
         message_id = payload.message_id
-        reaction = str(payload.emoji)
-        reaction_roles = await ReactionRole.select(message_id=message_id, reaction=reaction)
-        if len(reaction_roles):
+        # reactions on anything that isn't a role menu stop here, without a query
+        role_id = (await self.reaction_roles.get(message_id, {})).get(str(payload.emoji))
+        if role_id is not None:
             guild = self.bot.get_guild(payload.guild_id)
             member = guild.get_member(payload.user_id)
-            role = guild.get_role(reaction_roles[0].role_id)
+            role = guild.get_role(role_id)
             if member.bot:
                 return
             if role:
@@ -101,7 +152,8 @@ class Roles(Cog):
         me = member.guild.me
         top_restorable = me.top_role.position if me.guild_permissions.manage_roles else 0
 
-        missing_roles = await MissingRole.select(guild_id=member.guild.id, member_id=member.id)
+        # on_member_remove may have only just written these, so don't read them from the replica
+        missing_roles = await MissingRole.select(guild_id=member.guild.id, member_id=member.id, _primary=True)
         # no missing rules to return
         if not missing_roles:
             return
@@ -127,8 +179,8 @@ class Roles(Cog):
             e.add_field(name='I couldn\'t restore these roles, as I don\'t have permission.',
                         value='\n'.join(sorted(cant_give)))
 
-        # let's also make regiving roles atomic...ish.
-        async with orm.acquire() as conn:
+        # let's also make regiving roles atomic.
+        async with MissingRole.transaction() as conn:
             for missing_role in missing_roles:
                 await missing_role.delete(_conn=conn)
 
@@ -147,11 +199,11 @@ class Roles(Cog):
         """Saves a member's roles when they leave in case they rejoin."""
         guild_id = member.guild.id
         member_id = member.id
-        async with orm.acquire() as conn:
+        async with MissingRole.transaction() as conn:
             await conn.fetch(f"DELETE FROM {MissingRole.table_name()} WHERE member_id=$1 AND guild_id=$2", member_id, guild_id)
-            for role in member.roles[1:]:  # Exclude the @everyone role
-                await MissingRole(role_id=role.id, role_name=role.name,
-                                  member_id=member_id, guild_id=guild_id).insert(_upsert="ON CONFLICT DO NOTHING", _conn=conn)
+            await MissingRole.insert_many((MissingRole(role_id=role.id, role_name=role.name, member_id=member_id, guild_id=guild_id)
+                                           for role in member.roles[1:]),  # Exclude the @everyone role
+                                          on_conflict="ON CONFLICT DO NOTHING", _conn=conn)
 
     async def giveme_purge(self, role_id_list):
         """Purges roles in the giveme database that no longer exist"""
@@ -164,7 +216,7 @@ class Roles(Cog):
     async def ctx_purge(self, ctx):
         """Purges all giveme roles that no longer exist in a guild"""
         counter = 0
-        roles = await GiveableRole.select(guild_id=ctx.guild.id)
+        roles = await GiveableRole.select(guild_id=ctx.guild.id, _primary=True)
         guild_roles = []
         role_id_list = []
         for i in ctx.guild.roles:
@@ -363,7 +415,7 @@ class Roles(Cog):
         menu_message = await self.safe_message_fetch(ctx, menu=menu)
 
         menu_embed = discord.Embed(title=f"Role Menu: {menu.name}")
-        menu_entries = await ReactionRole.select(message_id=menu.message_id)
+        menu_entries = await ReactionRole.select(message_id=menu.message_id, _primary=True)
         for entry in menu_entries:
             role = ctx.guild.get_role(entry.role_id)
             menu_embed.add_field(name=f"Role: {role}", value=f"{entry.reaction}: {role.mention}", inline=False)
@@ -430,6 +482,7 @@ class Roles(Cog):
             name=name
         )
         await e.update_or_add()
+        self.role_menus.set(message.id, e)
 
         menu_embed.set_footer(text=f"Menu ID: {message.id}, Total roles: {0}")
         await message.edit(embed=menu_embed)
@@ -466,7 +519,7 @@ class Roles(Cog):
         if role.managed:
             raise BadArgument("I am not allowed to assign that role!")
 
-        menu_return = await RoleMenu.select(guild_id=ctx.guild.id, message_id=message_id)
+        menu_return = await RoleMenu.select(guild_id=ctx.guild.id, message_id=message_id, _primary=True)
         menu = menu_return[0] if len(menu_return) else None
         message = await self.safe_message_fetch(ctx, menu=menu, channel=channel, message_id=message_id)
 
@@ -478,10 +531,11 @@ class Roles(Cog):
             reaction=str(emoji)
         )
 
-        old_reaction = await ReactionRole.select(message_id=message.id, role_id=role.id)
+        old_reaction = await ReactionRole.select(message_id=message.id, role_id=role.id, _primary=True)
         if len(old_reaction):
             await self.del_from_message(message, old_reaction[0])
         await self.add_to_message(message, reaction_role)
+        self._index_reaction_role(reaction_role)
 
         if menu:
             await self.update_role_menu(ctx, menu)
@@ -507,14 +561,15 @@ class Roles(Cog):
     async def delrole(self, ctx, channel: typing.Optional[discord.TextChannel], message_id: int, role: discord.Role):
         """Removes a reaction role from a message or a role menu"""
 
-        menu_return = await RoleMenu.select(guild_id=ctx.guild.id, message_id=message_id)
+        menu_return = await RoleMenu.select(guild_id=ctx.guild.id, message_id=message_id, _primary=True)
         menu = menu_return[0] if len(menu_return) else None
         message = await self.safe_message_fetch(ctx, menu=menu, channel=channel, message_id=message_id)
 
-        reaction = await ReactionRole.select(message_id=message.id, role_id=role.id)
+        reaction = await ReactionRole.select(message_id=message.id, role_id=role.id, _primary=True)
         if len(reaction):
             await self.del_from_message(message, reaction[0])
             await ReactionRole.delete(message_id=message.id, role_id=role.id)
+            self._unindex_reaction_role(message.id, role.id)
         if menu:
             await self.update_role_menu(ctx, menu)
 
@@ -565,6 +620,7 @@ class MissingRole(orm.Model):
     """Holds what roles a given member had when they last left the guild."""
     __tablename__ = 'missing_roles'
     __primary_key__ = ('role_id', 'member_id')
+    __indexes__ = (('guild_id', 'member_id'),)
 
     role_id: psqlt.bigint
     guild_id: psqlt.bigint
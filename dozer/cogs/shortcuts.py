@@ -23,7 +23,42 @@ class Shortcuts(Cog):
         super().__init__(bot)
         self.settings_cache = configcache.AsyncConfigCache(ShortcutSetting)
         self.cache = configcache.AsyncConfigCache(ShortcutEntry)
+        # guild id -> {lowercased shortcut name: value}, loaded the first time the guild needs it
         self.guild_table: Dict[int, Dict[str, str]] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+        orm.add_invalidation_listener(self._on_invalidation)
+
+    async def guild_shortcuts(self, guild_id):
+        """Returns a guild's shortcuts as a dict from lowercased name to value, loading them if they aren't in memory yet."""
+        shortcuts = self.guild_table.get(guild_id)
+        if shortcuts is not None:
+            return shortcuts
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.ensure_future(self._load_shortcuts(guild_id))
+        return await asyncio.shield(task)
+
+    async def _load_shortcuts(self, guild_id):
+        try:
+            shortcuts = {ent.name.lower(): ent.value for ent in await ShortcutEntry.select(guild_id=guild_id, _primary=True)}
+            # if the guild was invalidated while this was loading, the result may already be stale
+            if self._loading.get(guild_id) is asyncio.current_task():
+                self.guild_table[guild_id] = shortcuts
+            return shortcuts
+        finally:
+            if self._loading.get(guild_id) is asyncio.current_task():
+                del self._loading[guild_id]
+
+    def _on_invalidation(self, table_name, keys):
+        """Drops the shortcuts of guilds whose entries were written to, by this or any other process."""
+        if table_name not in (None, ShortcutEntry.table_name()):
+            return
+        if "guild_id" in keys:
+            self.guild_table.pop(keys["guild_id"], None)
+            self._loading.pop(keys["guild_id"], None)
+        else:
+            self.guild_table.clear()
+            self._loading.clear()
 
     """Commands for managing shortcuts/macros."""
     @has_permissions(manage_messages=True)
@@ -99,6 +134,8 @@ class Shortcuts(Cog):
             ent.value = cmd_msg
             await ent.insert()
         self.cache.invalidate_entry(guild_id=ctx.guild.id, name=cmd_name)
+        if ctx.guild.id in self.guild_table:
+            self.guild_table[ctx.guild.id][cmd_name.lower()] = cmd_msg
 
         await ctx.send("Updated command successfully.")
 
@@ -113,6 +150,8 @@ class Shortcuts(Cog):
         if ent:
             await ent.delete()
         self.cache.invalidate_entry(guild_id=ctx.guild.id, name=cmd_name)
+        if ctx.guild.id in self.guild_table:
+            self.guild_table[ctx.guild.id].pop(cmd_name.lower(), None)
 
         await ctx.send("Removed command successfully.")
     
@@ -167,14 +206,9 @@ class Shortcuts(Cog):
         if not c.startswith(setting.prefix):
             return
 
-        shortcuts = await ShortcutEntry.select(guild_id=msg.guild.id)
-        if not shortcuts:
-            return
-
-        for shortcut in shortcuts:
-            if c.lower() == shortcut.name.lower():
-                await msg.channel.send(shortcut.value)
-                return
+        value = (await self.guild_shortcuts(msg.guild.id)).get(c.lower())
+        if value is not None:
+            await msg.channel.send(value)
 
 class ShortcutSetting(orm.Model):
     """Provides a DB config to track mutes."""
@@ -1,19 +1,48 @@
 """a cog that handles actions around a starboard/hall of fame"""
+import asyncio
 import datetime
+import logging
+import time
 import typing
 import discord
 from discord.ext.commands import has_permissions, guild_only
 
 from ._utils import *
 from ..asyncdb.orm import orm
-from ..asyncdb import psqlt
+from ..asyncdb import psqlt, configcache, tableindex
+from ..asyncdb.writebehind import write_behind
 
+logger = logging.getLogger("dozer")
 
 class Starboard(Cog):
     """Various starboard functions."""
+    # seconds a message's reactions have to stay unchanged before its starboard post is updated
+    UPDATE_DEBOUNCE = 2.0
+    # seconds after which a message that keeps getting reactions is updated anyway
+    UPDATE_MAX_DELAY = 10.0
+
     def __init__(self, bot):
         super().__init__(bot)
-        self.config_cache = {}
+        self.config_cache = configcache.AsyncConfigCache(StarboardConfig)
+        # starred message id -> starboard message id, loaded on first use and kept up to date by this cog.
+        # table-wide notices only come from flushing buffered reaction counts, which never change the index
+        self.starred = tableindex.TableIndex(StarboardMessage, "message_id", self._load_starred, self._load_starred_message,
+                                             table_wide_reloads=False)
+        # message id -> [config, message, time of its latest reaction] for messages waiting on a starboard update
+        self._pending_updates = {}
+
+    @staticmethod
+    async def _load_starred():
+        return {ent.message_id: ent.starboard_message_id async for ent in StarboardMessage.iter_select(batch_size=1000)}
+
+    @staticmethod
+    async def _load_starred_message(message_id):
+        ent = await StarboardMessage.select_one(message_id=message_id)
+        return ent.starboard_message_id if ent is not None else None
+
+    async def starboard_message_id(self, message_id):
+        """Returns the id of a message's starboard post, or None if it isn't on the starboard."""
+        return await self.starred.get(message_id)
 
     def starboard_embed_footer(self, emoji=None, reaction_count=None):
         """create the footer for a starboard embed"""
@@ -55,15 +84,15 @@ class Starboard(Cog):
         starboard_channel = msg.guild.get_channel(config.channel_id)
         if starboard_channel is None:
             return
-        msg_ent = await StarboardMessage.select_one(message_id=msg.id)
-        reaction_count = ([r.count for r in msg.reactions if str(r.emoji) == config.emoji] or [0])[0]
+        starboard_message_id = await self.starboard_message_id(msg.id)
+        reaction_count = self.reaction_count(config, msg)
 
         starboard_msg_content = f"{config.emoji} **{reaction_count}** {starboard_channel.mention} {msg.author.mention}"
-        if msg_ent:
-            msg_ent.reaction_count = reaction_count
-            await msg_ent.update()
+        if starboard_message_id is not None:
+            write_behind.upsert(StarboardMessage(message_id=msg.id, starboard_message_id=starboard_message_id,
+                                                 reaction_count=reaction_count))
             try:
-                starboard_msg = await starboard_channel.fetch_message(msg_ent.starboard_message_id)
+                starboard_msg = await starboard_channel.fetch_message(starboard_message_id)
             except discord.NotFound:
                 return
             prev_embed = starboard_msg.embeds[0]
@@ -72,38 +101,80 @@ class Starboard(Cog):
             starboard_msg = await starboard_channel.send(starboard_msg_content, embed=self.make_starboard_embed(msg))
             msg_ent = StarboardMessage(message_id=msg.id, starboard_message_id=starboard_msg.id, reaction_count=reaction_count)
             await msg_ent.insert(_upsert="ON CONFLICT (message_id) DO UPDATE SET reaction_count=EXCLUDED.reaction_count")
+            self.starred.set(msg.id, starboard_msg.id)
+
+    async def remove_from_starboard(self, config, msg: discord.Message):
+        """Deletes a message's starboard post, if it has one."""
+        starboard_message_id = await self.starboard_message_id(msg.id)
+        if starboard_message_id is None:
+            return
+        starboard_channel = msg.guild.get_channel(config.channel_id)
+        if starboard_channel is None:
+            return
+        try:
+            starboard_msg = await starboard_channel.fetch_message(starboard_message_id)
+        except discord.NotFound:
+            return
+        await starboard_msg.delete()
+        star_ent = StarboardMessage(message_id=msg.id)
+        await write_behind.discard(star_ent)
+        await star_ent.delete()
+        self.starred.pop(msg.id)
+
+    @staticmethod
+    def reaction_count(config, msg: discord.Message):
+        """Returns how many of the starboard emoji a message has."""
+        return ([r.count for r in msg.reactions if str(r.emoji) == config.emoji] or [0])[0]
+
+    def schedule_update(self, config, msg: discord.Message):
+        """Queues a starboard update for a message. A burst of reactions collapses into one update once it quiets down."""
+        entry = self._pending_updates.get(msg.id)
+        if entry is None:
+            self._pending_updates[msg.id] = [config, msg, time.monotonic()]
+            self.bot.loop.create_task(self._debounced_update(msg.id))
+        else:
+            entry[:] = [config, msg, time.monotonic()]
+
+    async def _debounced_update(self, message_id):
+        """Waits for a message's reactions to go quiet, then brings its starboard post in line with the latest count.
+        Reactions arriving during the update get another one afterwards, so a message never has two updates running."""
+        entry = self._pending_updates[message_id]
+        try:
+            while True:
+                started = time.monotonic()
+                while True:
+                    now = time.monotonic()
+                    wait = min(entry[2] + self.UPDATE_DEBOUNCE, started + self.UPDATE_MAX_DELAY) - now
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                seen = entry[2]
+                config, msg = entry[0], entry[1]
+                if self.reaction_count(config, msg) >= config.threshold:
+                    await self.send_to_starboard(config, msg)
+                else:
+                    await self.remove_from_starboard(config, msg)
+                if entry[2] == seen:
+                    break
+        except Exception:
+            logger.exception(f"Failed to update the starboard entry for message {message_id}")
+        finally:
+            del self._pending_updates[message_id]
 
     @Cog.listener()
     async def on_reaction_add(self, reaction, member):
         """Handles core reaction logic."""
         msg = reaction.message
-        if not msg.guild:
+        if not msg.guild or member == msg.guild.me:
             return
-        if msg.guild.id in self.config_cache:
-            config = self.config_cache[msg.guild.id]
-        else:
-            config = await StarboardConfig.select_one(guild_id=msg.guild.id)
-            self.config_cache[msg.guild.id] = config
-
         # we cache null results for servers
-        if config is None:
+        config = await self.config_cache.query_one(guild_id=msg.guild.id)
+        if config is None or str(reaction.emoji) != config.emoji:
             return
 
-        if reaction.count >= config.threshold and str(reaction.emoji) == config.emoji and member != msg.guild.me:
-            await self.send_to_starboard(config, msg)
-        elif reaction.count < config.threshold:
-            star_ent = await StarboardMessage.select_one(message_id=msg.id)
-            if star_ent is None:
-                return
-            starboard_channel = msg.guild.get_channel(config.channel_id)
-            if starboard_channel is None:
-                return
-            try:
-                starboard_msg = await starboard_channel.fetch_message(star_ent.starboard_message_id)
-            except discord.NotFound:
-                return
-            await starboard_msg.delete()
-            await star_ent.delete()
+        # messages that aren't starred and are still below the threshold don't need anything
+        if reaction.count >= config.threshold or await self.starboard_message_id(msg.id) is not None:
+            self.schedule_update(config, msg)
 
     @Cog.listener()
     async def on_reaction_remove(self, reaction, member):
@@ -151,8 +222,7 @@ class Starboard(Cog):
         else:
             config = StarboardConfig(guild_id=ctx.guild.id, channel_id=channel.id, emoji=str(emoji), threshold=threshold)
             await config.insert()
-        if ctx.guild.id in self.config_cache:
-            del self.config_cache[ctx.guild.id]
+        self.config_cache.invalidate_entry(guild_id=ctx.guild.id)
         await ctx.send(embed=self.make_config_embed(ctx, f"Updated configuration for {ctx.guild}!", config))
     config.example_usage = """
     `{prefix}starboard config #hall-of-fame 🌟 5` - Set the bot to repost messages that have 5 star reactions to `#hall-of-fame`
@@ -166,6 +166,7 @@ class TeamNumbers(orm.Model):
     """DB object for tracking team associations."""
     __tablename__ = 'team_numbers'
     __primary_key__ = ("user_id", "team_number", "team_type")
+    __indexes__ = (("team_number", "team_type"),)
     user_id: psqlt.bigint
     team_number: psqlt.text
     team_type: psqlt.text
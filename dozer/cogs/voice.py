@@ -4,12 +4,32 @@ from discord.ext.commands import has_permissions
 
 from ._utils import *
 from ..asyncdb.orm import orm
-from ..asyncdb import psqlt
+from ..asyncdb import psqlt, tableindex
 
 
 class Voice(Cog):
     """Commands interacting with voice."""
 
+    def __init__(self, bot):
+        super().__init__(bot)
+        # voice channel id -> role id for every voicebind, loaded on first use and kept up to date by the commands here
+        self.voicebinds = tableindex.TableIndex(Voicebinds, "channel_id", self._load_voicebinds, self._load_voicebind)
+
+    @staticmethod
+    async def _load_voicebinds():
+        return {config.channel_id: config.role_id for config in await Voicebinds.select(_primary=True)}
+
+    @staticmethod
+    async def _load_voicebind(channel_id):
+        config = await Voicebinds.select_one(channel_id=channel_id)
+        return config.role_id if config is not None else None
+
+    async def bound_role_id(self, channel):
+        """Returns the id of the role bound to a voice channel, or None."""
+        if channel is None:
+            return None
+        return await self.voicebinds.get(channel.id)
+
     @Cog.listener('on_voice_state_update')
     async def on_voice_state_update(self, member, before, after):
         """Handles voicebinds when members join/leave voice channels"""
@@ -17,18 +37,22 @@ class Voice(Cog):
         if member.guild.me.guild_permissions.manage_roles and before.channel != after.channel:
             # determine if it's a join/leave event as well.
             # before and after are voice states
-            if before.channel is not None:
+            old_role = member.guild.get_role(await self.bound_role_id(before.channel) or 0)
+            new_role = member.guild.get_role(await self.bound_role_id(after.channel) or 0)
+            if old_role == new_role:
+                return
+            if old_role is not None and new_role is not None:
+                # a switch between two bound channels is a single member edit rather than a remove and then an add
+                roles = [role for role in member.roles[1:] if role != old_role]
+                if new_role not in roles:
+                    roles.append(new_role)
+                await member.edit(roles=roles)
+            elif old_role is not None:
                 # leave event, take role
-                config = await Voicebinds.select_one(channel_id=before.channel.id)
-                if config is not None:
-                    await member.remove_roles(member.guild.get_role(config.role_id))
-
-            if after.channel is not None:
+                await member.remove_roles(old_role)
+            else:
                 # join event, give role
-                config = await Voicebinds.select_one(channel_id=after.channel.id)
-                if config is not None:
-                    await member.add_roles(member.guild.get_role(config.role_id))
-
+                await member.add_roles(new_role)
 
     @command()
     @bot_has_permissions(manage_roles=True)
@@ -44,6 +68,7 @@ class Voice(Cog):
         else:
             config = Voicebinds(channel_id=voice_channel.id, role_id=role.id, guild_id=ctx.guild.id)
             await config.insert()
+        self.voicebinds.set(voice_channel.id, role.id)
 
         await ctx.send("Role `{role}` will now be given to users in voice channel `{voice_channel}`!".format(role=role,
                                                                                                              voice_channel=voice_channel))
@@ -62,6 +87,7 @@ class Voice(Cog):
         if config is not None:
             role = ctx.guild.get_role(config.role_id)
             await config.delete()
+            self.voicebinds.pop(voice_channel.id)
             await ctx.send(
                 "Role `{role}` will no longer be given to users in voice channel `{voice_channel}`!".format(
                     role=role, voice_channel=voice_channel))
@@ -0,0 +1,144 @@
+"""Batches log embeds per channel, so bursts of log events (e.g. a prune) don't turn into one rate limited send each."""
+import asyncio
+import collections
+import logging
+import time
+
+import discord
+
+logger = logging.getLogger("dozer")
+
+
+class _TokenBucket:
+    """Allows `rate` sends every `per` seconds, refilling continuously."""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Waits until a send is allowed, then uses it up."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class _ChannelQueue:
+    __slots__ = ("channel", "embeds", "bucket", "task")
+
+    def __init__(self, channel, rate, per):
+        self.channel = channel
+        self.embeds = collections.deque()
+        self.bucket = _TokenBucket(rate, per)
+        self.task = None
+
+
+class LogSink:
+    """Queues embeds per channel and sends them packed up to 10 to a message.
+
+    The first embed queued for a channel starts a `delay` second timer, so the rest of a burst can share its messages.
+    Each channel then sends at most `rate` messages every `per` seconds, which keeps us inside discord's per-channel
+    bucket instead of queueing up behind 429s; anything arriving meanwhile just makes the next messages fuller.
+    At most `max_queued` embeds wait per channel; past that the oldest ones are dropped.
+    """
+    # discord's limits for the embeds of a single message
+    MAX_EMBEDS = 10
+    MAX_CHARS = 6000
+
+    def __init__(self, delay=1.0, max_queued=500, rate=5, per=5.0):
+        self.delay = delay
+        self.max_queued = max_queued
+        self.rate = rate
+        self.per = per
+        # channel id -> _ChannelQueue
+        self._queues = {}
+        # created on first use, so that it belongs to the running event loop
+        self._closing = None
+        self.messages_sent = 0
+        self.embeds_sent = 0
+        self.embeds_dropped = 0
+        self.embeds_failed = 0
+
+    def send(self, channel, embed):
+        """Queues an embed to be sent to a channel."""
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = _ChannelQueue(channel, self.rate, self.per)
+        queue.channel = channel
+        if len(queue.embeds) >= self.max_queued:
+            queue.embeds.popleft()
+            self.embeds_dropped += 1
+        queue.embeds.append(embed)
+        if queue.task is None:
+            queue.task = asyncio.ensure_future(self._drain(queue))
+
+    def _closing_event(self):
+        if self._closing is None:
+            self._closing = asyncio.Event()
+        return self._closing
+
+    def _take_batch(self, embeds):
+        """Takes as many queued embeds as fit in one message."""
+        batch = [embeds.popleft()]
+        size = len(batch[0])
+        while embeds and len(batch) < self.MAX_EMBEDS and size + len(embeds[0]) <= self.MAX_CHARS:
+            size += len(embeds[0])
+            batch.append(embeds.popleft())
+        return batch
+
+    async def _drain(self, queue):
+        try:
+            closing = self._closing_event()
+            if not closing.is_set():
+                try:
+                    await asyncio.wait_for(closing.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            while queue.embeds:
+                await queue.bucket.acquire()
+                batch = self._take_batch(queue.embeds)
+                try:
+                    await queue.channel.send(embeds=batch)
+                except discord.HTTPException as e:
+                    self.embeds_failed += len(batch)
+                    logger.warning(f"Failed to send {len(batch)} log embeds to #{queue.channel} ({queue.channel.id}): {e}")
+                else:
+                    self.messages_sent += 1
+                    self.embeds_sent += len(batch)
+        finally:
+            queue.task = None
+
+    @property
+    def queued(self):
+        """Number of embeds waiting to be sent, over all channels."""
+        return sum(len(queue.embeds) for queue in self._queues.values())
+
+    async def close(self, timeout=10.0):
+        """Sends whatever is queued without waiting out the batching delay. Call before the bot disconnects."""
+        self._closing_event().set()
+        tasks = [queue.task for queue in self._queues.values() if queue.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        if self.queued:
+            logger.warning(f"Dropped {self.queued} log embeds that couldn't be sent before shutdown")
+
+    def stats(self):
+        """Returns queue depths and send/drop counters."""
+        return {
+            "queued": self.queued,
+            "busiest": sorted(((len(queue.embeds), channel_id) for channel_id, queue in self._queues.items() if queue.embeds),
+                              reverse=True)[:5],
+            "messages_sent": self.messages_sent,
+            "embeds_sent": self.embeds_sent,
+            "embeds_dropped": self.embeds_dropped,
+            "embeds_failed": self.embeds_failed,
+        }
+
+
+log_sink = LogSink()